@@ -0,0 +1,11 @@
+from pathlib import Path
+
+import os
+import sys
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# tools modules import each other by name and read `logging.conf` from the repository root
+sys.path.insert(0, str(ROOT / 'tools'))
+os.chdir(ROOT)
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip('mongomock')
+
+from benchmark import run_benchmark
+
+
+@pytest.mark.parametrize('sequential, s2_mode', [(False, 'single'), (True, 'batch')])
+def test_run_benchmark(sequential, s2_mode):
+    n = 12
+    report = run_benchmark(n, batch_size=5, s2_mode=s2_mode, sequential=sequential, latency={'acl':0., 's2':0., 'grobid':0.}, pdf_size=1024)
+    assert report['mongo'] == 'mongomock'
+    assert report['register']['inserted'] == n
+    assert report['documents']['written'] == n
+    assert report['register']['open'] == 0
+    assert report['requests']['grobid'] == n
@@ -0,0 +1,68 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from columnar import ColumnarReader, ColumnarWriter
+
+
+DOCUMENTS = [
+    {'acl_id':'P19-1001', 'words':['We', 'parse', '.', 'It', 'works', '.'], 'sentences':[[0, 3], [3, 6]], 'sections':[[0, 1], [1, 2]]},
+    {'acl_id':'2020.acl-main.1', 'words':[], 'sentences':[], 'sections':[[0, 0]]},
+    {'acl_id':'W18-5401', 'words':['Thanks', '!'], 'sentences':[[0, 2]], 'sections':[[0, 1]]},
+]
+
+
+def write(path, documents=DOCUMENTS, shard_size=2):
+    with ColumnarWriter(path, shard_size) as writer:
+        writer.write_many(documents)
+
+
+def test_writer_refuses_other_directories(tmp_path):
+    (tmp_path / 'notes.txt').write_text('keep me')
+    with pytest.raises(FileExistsError):
+        ColumnarWriter(tmp_path)
+    assert (tmp_path / 'notes.txt').read_text() == 'keep me'
+    assert [path.name for path in tmp_path.iterdir()] == ['notes.txt']
+
+
+def test_writer_replaces_columnar_directory(tmp_path):
+    path = tmp_path / 'out'
+    path.mkdir() # empty directories are accepted
+    write(path)
+    write(path, DOCUMENTS[:1])
+    assert len(ColumnarReader(path)) == 1
+    assert [path.name for path in tmp_path.iterdir()] == ['out']
+
+
+def test_writer_error_keeps_previous_output(tmp_path):
+    path = tmp_path / 'out'
+    write(path)
+    with pytest.raises(RuntimeError):
+        with ColumnarWriter(path) as writer:
+            writer.write(DOCUMENTS[0])
+            raise RuntimeError('tokenizer failed')
+    assert len(ColumnarReader(path)) == 3
+    assert [path.name for path in tmp_path.iterdir()] == ['out']
+
+
+def test_reader_documents_and_acl_id_index(tmp_path):
+    write(tmp_path / 'out')
+    reader = ColumnarReader(tmp_path / 'out')
+    assert len(reader) == 3 and reader.meta['shards'] == 2
+    for index, document in enumerate(DOCUMENTS):
+        found = reader.get(document['acl_id'])
+        assert found['acl_id'] == document['acl_id']
+        assert found['words'] == document['words']
+        assert found['sentences'].tolist() == document['sentences']
+        assert found['sections'].tolist() == document['sections']
+        assert reader.index(document['acl_id']) == index
+    assert reader._vocab is None # only words of read documents were decoded
+    assert [document['words'] for document in reader] == [document['words'] for document in DOCUMENTS]
+    for acl_id in ['P19-100', 'P19-10011', 'Z99-9999-too-long-for-the-index', '']:
+        assert reader.get(acl_id) is None
+
+
+def test_reader_opens_without_json_tables(tmp_path):
+    write(tmp_path / 'out')
+    assert sorted(path.name for path in (tmp_path / 'out').glob('*.json')) == ['meta.json']
+    assert not list((tmp_path / 'out').glob('shard-*/*.json'))
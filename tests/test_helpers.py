@@ -0,0 +1,14 @@
+import pytest
+
+from helpers import JsonlWriter, read_jsonl
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-16', 'utf-32', 'utf-8-sig'])
+@pytest.mark.parametrize('suffix', ['.jsonl', '.jsonl.gz'])
+def test_append_writes_a_single_bom(tmp_path, encoding, suffix):
+    path = tmp_path / f'data{suffix}'
+    with JsonlWriter(path, append=True, encoding=encoding) as writer: # new file
+        writer.write({'id':1, 'text':'café'})
+    with JsonlWriter(path, append=True, encoding=encoding) as writer:
+        writer.write_many([{'id':2, 'text':'naïve'}, {'id':3, 'text':'x'}])
+    assert read_jsonl(path, encoding) == [{'id':1, 'text':'café'}, {'id':2, 'text':'naïve'}, {'id':3, 'text':'x'}]
@@ -0,0 +1,68 @@
+import copy
+import random
+
+import pytest
+
+from process_jsonl import benchmark_build_tsv, build_tsv, build_tsv_reference
+
+
+def make_synthetic_doc(rng, n_tokens, n_clusters, n_entities, messy=False):
+    """
+        Random json document : sorted sentences, entities, coreference clusters and relations between clusters.
+        Messy documents also have overlapping entities, empty and repeated coreference spans.
+    """
+    words = [rng.choice(['the', 'model', 'BERT', 'é', 'dataset', '.']) for _ in range(n_tokens)]
+    cuts = sorted(rng.sample(range(1, n_tokens), min(n_tokens - 1, n_tokens // 15))) if n_tokens > 1 else []
+    bounds = [0] + cuts + [n_tokens]
+    sentences = [[bounds[k], bounds[k + 1]] for k in range(len(bounds) - 1)]
+    ner, position = [], 0
+    while len(ner) < n_entities and position < n_tokens:
+        position += rng.randint(0, 20)
+        length = rng.randint(1, 4)
+        if position + length <= n_tokens:
+            ner.append([position, position + length, rng.choice(['Method', 'Task', 'Material', 'Metric'])])
+        position += length - (3 if messy and rng.random() < .1 else 0)
+    coref = {}
+    for c in range(n_clusters):
+        starts = [rng.randrange(max(1, n_tokens)) for _ in range(rng.randint(0, 6))]
+        coref[f'cluster_{c}'] = [[start, start + rng.randint(0 if messy else 1, 3)] for start in starts]
+    keys = list(coref)
+    relations = [
+        {'Method':rng.choice(keys), 'Task':rng.choice(keys), 'Material':rng.choice(keys + ['unknown']), 'score':rng.random()}
+        for _ in range(rng.randint(0, 5))] if keys else []
+    return {'doc_id':'synthetic', 'sentences':sentences, 'words':words, 'ner':ner, 'coref':coref, 'n_ary_relations':relations}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_build_tsv_matches_reference(seed):
+    rng = random.Random(seed)
+    for i in range(400):
+        json_doc = make_synthetic_doc(rng, rng.randint(0, 200), rng.randint(0, 15), rng.randint(0, 30), messy=i % 3 == 0)
+        expected = build_tsv_reference(copy.deepcopy(json_doc))
+        assert build_tsv(json_doc) == expected
+
+
+def test_build_tsv_large_document():
+    json_doc = make_synthetic_doc(random.Random(0), 5000, 100, 500)
+    assert build_tsv(json_doc) == build_tsv_reference(copy.deepcopy(json_doc))
+
+
+def test_build_tsv_keeps_input():
+    json_doc = make_synthetic_doc(random.Random(0), 100, 5, 10, messy=True)
+    original = copy.deepcopy(json_doc)
+    build_tsv(json_doc)
+    assert json_doc == original
+
+
+def test_build_tsv_unsorted_sentences_fall_back_to_reference():
+    json_doc = make_synthetic_doc(random.Random(0), 60, 3, 6)
+    for sentences in ([[20, 40], [0, 20], [40, 60]], [[0, 30], [20, 60]]):
+        json_doc['sentences'] = sentences
+        original = copy.deepcopy(json_doc)
+        assert build_tsv(json_doc) == build_tsv_reference(copy.deepcopy(json_doc))
+        assert json_doc == original
+
+
+def test_benchmark_build_tsv():
+    results = benchmark_build_tsv([(200, 5), (1000, 20)])
+    assert list(results) == [(200, 5), (1000, 20)]
@@ -0,0 +1,24 @@
+import pytest
+
+spacy = pytest.importorskip('spacy')
+
+from process_sample import SPACY_MODEL, load_tokenizer, tokenizer_cache_path
+
+
+if not spacy.util.is_package(SPACY_MODEL):
+    pytest.skip(f'spacy model {SPACY_MODEL} is not installed', allow_module_level=True)
+
+
+TEXT = 'BERT (Devlin et al., 2019) reaches 93.2% F1 on e.g. CoNLL-2003, see https://example.org/paper.'
+
+
+def tokens(tokenizer):
+    return [token.text for token in tokenizer(TEXT)]
+
+
+def test_cached_tokenizer_matches_full_pipeline(tmp_path):
+    cache_dir = tmp_path / 'tokenizers'
+    reference = tokens(load_tokenizer(SPACY_MODEL, full=True))
+    assert tokens(load_tokenizer(SPACY_MODEL, cache_dir)) == reference # serialized in the empty cache
+    assert tokenizer_cache_path(SPACY_MODEL, cache_dir).is_dir()
+    assert tokens(load_tokenizer(SPACY_MODEL, cache_dir)) == reference # read from the cache
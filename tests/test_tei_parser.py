@@ -0,0 +1,97 @@
+from xml.etree import ElementTree
+
+import pytest
+
+import tei_parser
+from tei_parser import compare_sections, parse_tei, split_doc
+
+
+def make_tei(body, back=''):
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+    <teiHeader>
+        <fileDesc>
+            <titleStmt><title level="a" type="main">Parsing &amp; Tagging</title></titleStmt>
+        </fileDesc>
+        <profileDesc>
+            <abstract><div><p><s>We parse.</s><s>We tag.</s></p></div></abstract>
+        </profileDesc>
+    </teiHeader>
+    <text>
+        <body>{body}</body>
+        <back>{back}</back>
+    </text>
+</TEI>'''
+
+
+@pytest.fixture(params=['default', 'stdlib'], autouse=True)
+def backend(request, monkeypatch):
+    # lxml when installed, and the standard library fallback
+    if request.param == 'stdlib':
+        monkeypatch.setattr(tei_parser, 'etree', ElementTree)
+        monkeypatch.setattr(tei_parser, 'ITERPARSE_OPTIONS', {})
+    return request.param
+
+
+def test_title_abstract_and_refs():
+    doc = make_tei('''
+        <div><head n="1">Introduction</head>
+            <p><s>BERT <ref type="bibr" target="#b0">(Devlin et al., 2019)</ref> is used.</s>
+            <s coords="1,2,3,4,5">See <ref type="figure" target="#fig_0">Figure 1</ref> and <hi rend="italic">Table</hi> 2.</s></p>
+        </div>''')
+    assert parse_tei(doc) == [
+        ['Parsing & Tagging', 'We parse.', 'We tag.'],
+        ['BERT  is used.', 'See [reference] and Table 2.']]
+
+
+def test_entities_are_unescaped():
+    doc = make_tei('''
+        <div><head>Results</head><p><s>F1 &amp; recall are &lt; 0.5 &gt; 0.2.</s></p></div>''')
+    sections = parse_tei(doc)
+    assert sections[0][0] == 'Parsing & Tagging'
+    assert sections[1] == ['F1 & recall are < 0.5 > 0.2.']
+
+
+def test_figure_sentences_stay_in_previous_section():
+    doc = make_tei('''
+        <div><head>Method</head><p><s>We train a model.</s></p></div>
+        <figure xml:id="fig_0"><head>Figure 1:</head><label>1</label><figDesc><s>Model architecture.</s></figDesc></figure>
+        <div><head>Results</head><p><s>It works.</s></p></div>''')
+    assert parse_tei(doc)[1:] == [
+        ['We train a model.', 'Model architecture.'],
+        ['It works.']]
+
+
+def test_last_section_is_kept():
+    doc = make_tei('''
+        <div><head>Introduction</head><p><s>First.</s></p></div>''', '''
+        <div type="acknowledgement"><div><head>Acknowledgments</head><p><s>Thanks.</s></p></div></div>''')
+    assert parse_tei(doc)[1:] == [['First.'], ['Thanks.']]
+
+
+@pytest.mark.parametrize('body, back', [
+    ('''
+        <div><head n="1">Introduction</head>
+            <p><s>BERT <ref type="bibr" target="#b0">(Devlin et al., 2019)</ref> is used.</s>
+            <s>See <ref type="figure" target="#fig_0">Figure 1</ref> and <hi rend="italic">Table</hi> 2.</s></p>
+        </div>
+        <div><head n="2">Method</head><p><s>We train a model.</s></p></div>''', ''),
+    ('''
+        <div><head>Results</head><p><s>F1 &amp; recall are &lt; 0.5 &gt; 0.2.</s><s coords="1,2,3,4,5">It works.</s></p></div>
+        <figure xml:id="fig_0"><head>Figure 1:</head><label>1</label><figDesc><s>Model architecture.</s></figDesc></figure>
+        <div><head>Conclusion</head><p><s>Done.</s></p></div>''', '''
+        <div type="acknowledgement"><div><head>Acknowledgments</head><p><s>Thanks.</s></p></div></div>'''),
+])
+def test_regex_path_is_subsequence(body, back):
+    doc = make_tei(body, back)
+    expected, found = split_doc(doc), parse_tei(doc)
+    assert sum(map(len, expected[1:])) > 0
+    assert compare_sections(expected, found) in ('identical', 'equivalent')
+
+
+def test_compare_sections_detects_differences():
+    expected = [['Title', 'Abstract.'], ['First.', 'Second.']]
+    assert compare_sections(expected, expected) == 'identical'
+    assert compare_sections(expected, expected + [['Last.']]) == 'equivalent'
+    assert compare_sections(expected, [expected[0], ['Second.', 'First.']]) is None
+    assert compare_sections(expected, [['Other title', 'Abstract.'], expected[1]]) is None
@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+import mongomock.gridfs
+
+import update_documents
+from client import STORAGE_GRIDFS_THRESHOLD, decode_document
+from update_documents import claim_batch, write_batch
+
+
+mongomock.gridfs.enable_gridfs_integration()
+mongomock.ignore_feature('session') # sessions are accepted and ignored
+
+
+class TransactionSession:
+    """
+        Stand-in of a transaction session for mongomock : GridFS refuses it like a real one.
+    """
+    in_transaction = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def with_transaction(self, callback):
+        self.in_transaction = True
+        try:
+            return callback(self)
+        finally:
+            self.in_transaction = False
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def transaction(db, monkeypatch):
+    monkeypatch.setattr(update_documents, 'supports_transactions', lambda client: True)
+    monkeypatch.setattr(db.client, 'start_session', TransactionSession, raising=False)
+
+
+def claimed_batch(register, acl_ids, grobid):
+    register.insert_many([{'acl_id':acl_id, 'close':False, 'steps':[], 'lease':{'worker':'w1', 'expires':0}} for acl_id in acl_ids])
+    entries = list(register.find({'acl_id':{'$in':acl_ids}}))
+    return entries, [{'acl_id':entry['acl_id'], 'grobid':grobid} for entry in entries]
+
+
+def test_write_batch_offloads_before_transaction(db, transaction):
+    register, documents, files = db.register, db.documents, db['documents_fs.files']
+    big = 'x' * (STORAGE_GRIDFS_THRESHOLD + 1)
+    write_batch(claimed_batch(register, ['A', 'B'], big), register, documents, 'w1')
+    assert files.count_documents({}) == 2
+    assert register.count_documents({'close':True}) == 2
+
+    register.delete_many({})
+    write_batch(claimed_batch(register, ['A'], big + 'y'), register, documents, 'w1') # replaced files are deleted after commit
+    assert files.count_documents({}) == 2
+    assert decode_document(documents.find_one({'acl_id':'A'}), documents)['grobid'] == big + 'y'
+
+
+def test_write_batch_aborted_transaction_deletes_files(db, transaction, monkeypatch):
+    register, documents, files = db.register, db.documents, db['documents_fs.files']
+    def failing_bulk_write(*args, **kwargs):
+        raise RuntimeError('register write failed')
+    monkeypatch.setattr(update_documents, 'bulk_write', failing_bulk_write)
+    with pytest.raises(RuntimeError):
+        write_batch(claimed_batch(register, ['A'], 'x' * (STORAGE_GRIDFS_THRESHOLD + 1)), register, documents, 'w1')
+    assert files.count_documents({}) == 0
+
+
+def open_entries(register, n):
+    register.insert_many([{'acl_id':f'P{i:02d}', 'close':False, 'steps':[]} for i in range(n)])
+
+
+def test_claim_batch_workers_never_share_entries(db):
+    register = db.register
+    open_entries(register, 10)
+    claimed = {'w1':[], 'w2':[]}
+    while True:
+        batches = {worker_id:claim_batch(register, 3, worker_id)[0] for worker_id in claimed}
+        if not any(batches.values()):
+            break
+        for worker_id, entries in batches.items():
+            claimed[worker_id] += [entry['acl_id'] for entry in entries]
+    assert len(claimed['w1']) + len(claimed['w2']) == 10
+    assert not set(claimed['w1']) & set(claimed['w2'])
+    assert all(entry['lease']['worker'] == ('w1' if entry['acl_id'] in claimed['w1'] else 'w2') for entry in register.find())
+
+
+def test_claim_batch_reclaims_expired_lease(db):
+    register, documents = db.register, db.documents
+    open_entries(register, 2)
+    stale = claim_batch(register, 2, 'w1', lease_seconds=.1)
+    assert len(stale[0]) == 2
+    time.sleep(.2) # w1 stalled, its leases expired
+    batch = claim_batch(register, 2, 'w2')
+    assert [entry['acl_id'] for entry in batch[0]] == [entry['acl_id'] for entry in stale[0]]
+    assert all(entry['claims'] == 2 for entry in batch[0])
+
+    stats = write_batch(stale, register, documents, 'w1') # w1 no longer holds the leases
+    assert stats['entries_lost'] == 2
+    assert register.count_documents({'close':True}) == 0
+    stats = write_batch(batch, register, documents, 'w2')
+    assert stats['entries_lost'] == 0
+    assert register.count_documents({'close':True}) == 2
+
+
+def test_write_batch_failure_is_persisted(db, monkeypatch):
+    register, documents = db.register, db.documents
+    def failing_upsert_many(*args, **kwargs):
+        raise RuntimeError('documents write failed')
+    monkeypatch.setattr(update_documents, 'upsert_many', failing_upsert_many)
+    monkeypatch.setattr(update_documents, 'RETRY_BASE_DELAY', 0) # retries are due at once
+    open_entries(register, 1)
+    for attempt in range(1, update_documents.RETRY_MAX_ATTEMPTS + 1):
+        batch = claim_batch(register, 1, 'w1')
+        assert len(batch[0]) == 1
+        batch[1][0]['s2'] = {'title':'kept'}
+        with pytest.raises(RuntimeError):
+            write_batch(batch, register, documents, 'w1')
+        entry = register.find_one()
+        assert entry['attempts'] == {'mongo':attempt}
+        assert 'lease' not in entry
+    assert entry['close'] and 'retry' not in entry
+    assert entry['steps'][-1]['code'] == update_documents.StepCode.ERROR.value
+    assert claim_batch(register, 1, 'w1')[0] == []
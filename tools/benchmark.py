@@ -0,0 +1,384 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter, sleep
+
+import gzip
+import hashlib
+import json
+import random
+import re
+import tempfile
+import threading
+
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
+
+try:
+    import mongomock
+except ImportError: # optional, a local mongod is used otherwise
+    mongomock = None
+
+import update_documents
+import update_register
+from update_documents import *
+from file_cache import FileCache
+from http_helpers import TokenBucket
+from metrics import metrics
+
+
+logger = logging.getLogger('benchmark')
+
+
+BENCHMARK_DB_NAME = os.getenv('BENCHMARK_DB_NAME', 'pwj-benchmark')
+
+
+class MockService:
+    """
+        Local stand-in http server of an external service, with configurable latency, error and 429 rates.
+        Runs in a daemon thread, `url` is its base url.
+
+        Parameters
+        ----------
+        name : str, service name (used in logs).
+        routes : list of tuple(str, str, callable), http method, path regex and handler
+            (takes regex match and request body, returns status code, content type and body bytes).
+        latency : float, default=0., mean latency in seconds of each response (uniform, +/- 50%).
+        error_rate : float, default=0., share of responses replaced by a 500.
+        throttle_rate : float, default=0., share of responses replaced by a 429 (with `Retry-After: 0`).
+        seed : int, default=0, random seed.
+    """
+
+    def __init__(self, name, routes, latency=0., error_rate=0., throttle_rate=0., seed=0):
+        self.name = name
+        self.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep alive, as real services
+
+            def handle_method(self, method):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                status, content_type, content, headers = service.respond(method, self.path.split('?')[0], body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_method('GET')
+
+            def do_POST(self):
+                self.handle_method('POST')
+
+            def log_message(self, format, *args): # no access log
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, name=f'mock_{name}', daemon=True).start()
+
+    def respond(self, method, path, body):
+        with self.lock:
+            self.requests += 1
+            draw, delay = self.random.random(), self.latency * self.random.uniform(.5, 1.5)
+        if delay:
+            sleep(delay)
+        if draw < self.throttle_rate:
+            return 429, 'application/json', b'{"message": "Too Many Requests"}', {'Retry-After':'0'}
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, 'application/json', b'{"error": "Internal Server Error"}', {}
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(path)
+            if route_method == method and match:
+                status, content_type, content = handler(match, body)
+                return status, content_type, content, {}
+        return 404, 'application/json', b'{"error": "Not found"}', {}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_acl_ids(n, seed=0):
+    """
+        Generate `n` distinct synthetic acl ids (`<year>.<venue>-<track>.<number>`).
+    """
+    rng = random.Random(seed)
+    venues = ['acl', 'emnlp', 'naacl', 'eacl', 'coling', 'findings']
+    return [f'{rng.randint(2000, 2023)}.{rng.choice(venues)}-long.{i}' for i in range(n)]
+
+
+def make_anthology(acl_ids):
+    """
+        Build a gzipped bibtex anthology listing `acl_ids`.
+    """
+    entries = [
+        f'@inproceedings{{paper{i},\n    title = "Synthetic paper {i}",\n    url = "https://aclanthology.org/{acl_id}",\n    pages = "1--10",\n}}\n'
+        for i, acl_id in enumerate(acl_ids)]
+    return gzip.compress(''.join(entries).encode('utf-8'))
+
+
+def make_s2_paper(acl_id, refs=20):
+    """
+        Build a synthetic S2 paper, with `refs` citations and references.
+    """
+    paper_id = hashlib.sha1(acl_id.encode('utf-8')).hexdigest()
+    related = [{'paperId':hashlib.sha1(f'{acl_id}-{i}'.encode('utf-8')).hexdigest(), 'title':f'Related paper {i}', 'year':2020} for i in range(refs)]
+    return {
+        'paperId':paper_id, 'externalIds':{'ACL':acl_id}, 'title':f'Synthetic paper {acl_id}', 'abstract':'Synthetic abstract. ' * 20,
+        'year':2020, 'authors':[{'authorId':str(i), 'name':f'Author {i}'} for i in range(3)],
+        'citationCount':refs, 'referenceCount':refs, 'citations':related, 'references':related}
+
+
+def make_pdf(acl_id, size):
+    """
+        Build a synthetic pdf of `size` bytes (valid magic bytes, deterministic content).
+    """
+    head = b'%PDF-1.4\n%' + acl_id.encode('utf-8') + b'\n'
+    seed = hashlib.sha256(acl_id.encode('utf-8')).digest()
+    return head + (seed * (size // len(seed) + 1))[:max(0, size - len(head))]
+
+
+def make_tei(title, sections=8, sentences=10):
+    """
+        Build a synthetic grobid TEI document : title, abstract and `sections` sections of `sentences` sentences,
+        with bibliographic and other references.
+    """
+    sentence = '<s>This is a synthetic sentence with a <ref type="bibr" target="#b0">citation [1]</ref> and <ref type="figure" target="#fig_0">Figure 1</ref> in it.</s>'
+    divs = ''.join(f'<div xmlns="http://www.tei-c.org/ns/1.0"><head n="{i}">Section {i}</head><p>{sentence * sentences}</p></div>' for i in range(1, sections + 1))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc><titleStmt>'
+        f'<title level="a" type="main">{title}</title></titleStmt></fileDesc><profileDesc><abstract><div><p>{sentence * 3}</p></div></abstract>'
+        f'</profileDesc></teiHeader><text><body>{divs}</body><back><div type="references"><listBibl/></div></back></text></TEI>')
+
+
+def start_mock_services(acl_ids, latency=None, error_rate=0., throttle_rate=0., pdf_size=200 * 1024, refs=20, sections=8, seed=0):
+    """
+        Start mock anthology (bibtex and pdfs), S2 and GROBID services.
+
+        Parameters
+        ----------
+        acl_ids : list[str], acl ids listed in anthology.
+        latency : dict, default=None, service name (`acl`, `s2`, `grobid`) -> mean latency in seconds.
+        error_rate : float, default=0., share of 500 responses of each service.
+        throttle_rate : float, default=0., share of 429 responses of each service.
+        pdf_size : int, default=200 KB, size of synthetic pdfs.
+        refs : int, default=20, citations and references by S2 paper.
+        sections : int, default=8, sections by TEI document.
+        seed : int, default=0, random seed.
+
+        Returns
+        -------
+        services : dict, service name -> MockService.
+    """
+    latency = {'acl':.05, 's2':.1, 'grobid':.5, **(latency or {})}
+    anthology = make_anthology(acl_ids)
+
+    def s2_paper(match, body):
+        return 200, 'application/json', json.dumps(make_s2_paper(match.group(1), refs)).encode('utf-8')
+
+    def s2_batch(match, body):
+        ids = json.loads(body)['ids']
+        return 200, 'application/json', json.dumps([make_s2_paper(paper_id[len('ACL:'):], refs) for paper_id in ids]).encode('utf-8')
+
+    def s2_list(match, body):
+        return 200, 'application/json', b'{"offset": 0, "data": []}'
+
+    def grobid(match, body):
+        return 200, 'application/xml', make_tei(f'Synthetic paper {hashlib.sha1(body).hexdigest()[:8]}', sections).encode('utf-8')
+
+    return {
+        'acl':MockService('acl', [
+            ('GET', r'/anthology\.bib\.gz', lambda match, body: (200, 'application/gzip', anthology)),
+            ('GET', r'/(.+)\.pdf', lambda match, body: (200, 'application/pdf', make_pdf(match.group(1), pdf_size)))],
+            latency['acl'], error_rate, throttle_rate, seed),
+        's2':MockService('s2', [
+            ('GET', r'/graph/v1/paper/ACL:(.+)', s2_paper),
+            ('POST', r'/graph/v1/paper/batch', s2_batch),
+            ('GET', r'/graph/v1/paper/[^/]+/(?:citations|references)', s2_list)],
+            latency['s2'], error_rate, throttle_rate, seed + 1),
+        'grobid':MockService('grobid', [('POST', r'/api/processFulltextDocument', grobid)], latency['grobid'], error_rate, throttle_rate, seed + 2)}
+
+
+def peak_rss():
+    """
+        Peak resident set size of current process in bytes, None if unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # bytes on macos, kilobytes on linux
+
+
+def summarize(snapshot, name):
+    return {
+        '/'.join(str(value) for value in item['labels'].values()) or name:{'count':item['count'], 'p50':item['p50'], 'p99':item['p99']}
+        for item in snapshot.get(name, [])}
+
+
+def run_benchmark(n=200, batch_size=50, s2_mode='single', sequential=False, mongo_uri=None, latency=None, error_rate=0., throttle_rate=0., pdf_size=200 * 1024, seed=0):
+    """
+        Push `n` synthetic papers through `sync_anthology` and the `update_documents` pipeline (or `process_batch`
+        when `sequential`), against mock services and mongomock (or the local mongod of `mongo_uri`, database
+        BENCHMARK_DB_NAME is dropped). Rate limits and file cache are disabled, everything else is as in production.
+
+        Parameters
+        ----------
+        n : int, default=200, count of synthetic papers.
+        batch_size : int, default=50, entries by batch.
+        s2_mode : str, default='single', s2 api mode (`single` or `batch`).
+        sequential : bool, default=False, use `process_batch` instead of the staged pipeline.
+        mongo_uri : str, default=None, mongodb uri, mongomock if None.
+        latency : dict, default=None, service name (`acl`, `s2`, `grobid`) -> mean latency in seconds.
+        error_rate : float, default=0., share of 500 responses of each service.
+        throttle_rate : float, default=0., share of 429 responses of each service.
+        pdf_size : int, default=200 KB, size of synthetic pdfs.
+        seed : int, default=0, random seed.
+
+        Returns
+        -------
+        report : dict, throughputs, register entries left open, p50/p99 latencies by stage and step, http status codes and peak rss.
+    """
+    acl_ids = make_acl_ids(n, seed)
+    services = start_mock_services(acl_ids, latency, error_rate, throttle_rate, pdf_size, seed=seed)
+    tmp = tempfile.TemporaryDirectory()
+    if mongo_uri:
+        client = MongoClient(mongo_uri)
+    elif mongomock is not None:
+        client = mongomock.MongoClient()
+    else:
+        logger.error(f'`mongomock` is not installed, give a mongodb uri (--mongo-uri)')
+        sys.exit(1)
+    client.drop_database(BENCHMARK_DB_NAME)
+    db = client[BENCHMARK_DB_NAME]
+    try:
+        ensure_indexes(db)
+    except Exception as e:
+        logger.warning(f'indexes not created ({type(e).__name__}), queries are not representative')
+    register, documents = db[MONGO_REGISTER_COLLECTION], db[MONGO_DOCUMENTS_COLLECTION]
+
+    grobid_config = json.loads(GROBID_CONFIG_PATH.read_text(encoding='utf-8'))
+    grobid_config.update({'grobid_server':services['grobid'].url, 'sleep_time':.05})
+    grobid_config_path = Path(tmp.name) / 'grobid_config.json'
+    grobid_config_path.write_text(json.dumps(grobid_config), encoding='utf-8')
+    update_documents.S2_API_URL = f'{services["s2"].url}/graph/v1/paper/'
+    update_documents.ACL_PDF_URL = services['acl'].url
+    update_documents.GROBID_CONFIG_PATH = grobid_config_path
+    update_documents.s2_limiter = TokenBucket(0)
+    update_documents.acl_limiter = TokenBucket(0)
+    update_documents.file_cache = FileCache(Path(tmp.name) / 'cache', 0)
+    metrics.reset()
+
+    try:
+        t = perf_counter()
+        inserted, _ = update_register.sync_anthology(register, f'{services["acl"].url}/anthology.bib.gz', Path(tmp.name) / 'anthology')
+        register_time = perf_counter() - t
+
+        t = perf_counter()
+        if sequential:
+            while len((batch := claim_batch(register, batch_size))[0]):
+                with metrics.timer('pipeline_batch_seconds'):
+                    process_batch(batch, register, documents, s2_mode)
+        else:
+            run_pipeline(register, documents, batch_size, s2_mode, metrics_port=0, metrics_interval=0)
+        documents_time = perf_counter() - t
+
+        snapshot = metrics.snapshot()
+        written = documents.count_documents({})
+        report = {
+            'n':n, 'batch_size':batch_size, 's2_mode':s2_mode, 'sequential':sequential, 'mongo':'mongod' if mongo_uri else 'mongomock',
+            'latency':{name:service.latency for name, service in services.items()}, 'error_rate':error_rate, 'throttle_rate':throttle_rate,
+            'register':{'inserted':inserted, 'open':register.count_documents({'close':False}), 'seconds':register_time, 'ids_per_sec':inserted / max(register_time, 1e-9)},
+            'documents':{'written':written, 'seconds':documents_time, 'docs_per_sec':written / max(documents_time, 1e-9)},
+            'stages':summarize(snapshot, 'pipeline_stage_seconds'),
+            'steps':summarize(snapshot, 'document_step_seconds'),
+            'batches':summarize(snapshot, 'pipeline_batch_seconds'),
+            'http_responses':{f'{item["labels"]["host"]} {item["labels"]["status"]}':item['value'] for item in snapshot.get('http_responses_total', [])},
+            'requests':{name:service.requests for name, service in services.items()},
+            'peak_rss':peak_rss()}
+        return report
+    finally:
+        for service in services.values():
+            service.close()
+        client.drop_database(BENCHMARK_DB_NAME)
+        client.close()
+        tmp.cleanup()
+
+
+def compare_reports(report, baseline, tolerance=.2):
+    """
+        Compare a report to a baseline one : throughput drop or p99 increase of a stage above `tolerance` is a regression.
+
+        Parameters
+        ----------
+        report : dict, current report.
+        baseline : dict, baseline report.
+        tolerance : float, default=.2, allowed relative degradation.
+
+        Returns
+        -------
+        regressions : list[str], regression descriptions, empty if none.
+    """
+    regressions = []
+    for section, key in [('register', 'ids_per_sec'), ('documents', 'docs_per_sec')]:
+        current, reference = report[section][key], baseline.get(section, {}).get(key)
+        if reference and current < reference * (1 - tolerance):
+            regressions.append(f'{section} {key} : {current:.2f} < {reference:.2f}')
+    for section in ['stages', 'steps']:
+        for name, stats in report[section].items():
+            reference = baseline.get(section, {}).get(name, {}).get('p99')
+            if reference and stats['p99'] and stats['p99'] > reference * (1 + tolerance):
+                regressions.append(f'{section} {name} p99 : {stats["p99"]:.3f}s > {reference:.3f}s')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Benchmark register and documents ingestion against mock S2, ACL and GROBID services.')
+    parser.add_argument('-n', type=int, default=200, help='count of synthetic papers')
+    parser.add_argument('--batch-size', type=int, default=50, help='entries by batch')
+    parser.add_argument('--s2-mode', choices=['single', 'batch'], default='single', help='s2 api mode')
+    parser.add_argument('--sequential', action='store_true', help='use process_batch instead of the staged pipeline')
+    parser.add_argument('--mongo-uri', default=None, help='mongodb uri of a local mongod (mongomock if not given)')
+    parser.add_argument('--acl-latency', type=float, default=.05, help='mean latency in seconds of mock anthology')
+    parser.add_argument('--s2-latency', type=float, default=.1, help='mean latency in seconds of mock S2')
+    parser.add_argument('--grobid-latency', type=float, default=.5, help='mean latency in seconds of mock GROBID')
+    parser.add_argument('--error-rate', type=float, default=0., help='share of 500 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0., help='share of 429 responses')
+    parser.add_argument('--pdf-size', type=int, default=200 * 1024, help='size in bytes of synthetic pdfs')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', type=Path, default=None, help='path of json report to write')
+    parser.add_argument('--baseline', type=Path, default=None, help='path of a json report to compare with, exit with 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=.2, help='allowed relative degradation against baseline')
+    args = parser.parse_args()
+
+    latency = {'acl':args.acl_latency, 's2':args.s2_latency, 'grobid':args.grobid_latency}
+    report = run_benchmark(args.n, args.batch_size, args.s2_mode, args.sequential, args.mongo_uri, latency, args.error_rate, args.throttle_rate, args.pdf_size, args.seed)
+    logger.info(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+
+    if args.baseline:
+        regressions = compare_reports(report, json.loads(args.baseline.read_text(encoding='utf-8')), args.tolerance)
+        for regression in regressions:
+            logger.error(f'regression : {regression}')
+        if regressions:
+            sys.exit(1)
+        logger.info(f'no regression against {args.baseline}')
@@ -1,13 +1,22 @@
 from typing import Any, Dict, List, Mapping, Optional
 from gridfs import ClientSession
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, UpdateMany, ReplaceOne
+from bson import Binary
 from logging import config
 from datetime import datetime
 
+import bson
+import gridfs
+import gzip
 import pymongo
 import logging
 import os, sys
 
+try:
+    import zstandard
+except ImportError: # zstd codec is optional
+    zstandard = None
+
 config.fileConfig('logging.conf')
 logger = logging.getLogger('mongoClient')
 
@@ -15,6 +24,23 @@ MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'pwj-db')
 MONGO_REGISTER_COLLECTION = os.getenv('MONGO_REGISTER_COLLECTION', 'register')
 MONGO_DOCUMENTS_COLLECTION = os.getenv('MONGO_DOCUMENTS_COLLECTION', 'documents')
 
+MONGO_INDEXES = { # collection -> indexes (create_index arguments), created by setup_db.py
+    MONGO_REGISTER_COLLECTION:[
+        {'keys':[('acl_id', pymongo.ASCENDING)], 'name':'acl_id_unique', 'unique':True},
+        {'keys':[('close', pymongo.ASCENDING), ('acl_id', pymongo.ASCENDING)], 'name':'open_entries', 'partialFilterExpression':{'close':False}},
+        {'keys':[('lease.worker', pymongo.ASCENDING)], 'name':'lease_worker', 'sparse':True},
+        {'keys':[('retry.next_attempt', pymongo.ASCENDING)], 'name':'retry_next_attempt', 'sparse':True},
+        {'keys':[('steps.name', pymongo.ASCENDING), ('steps.code', pymongo.ASCENDING)], 'name':'steps_name_code'}],
+    MONGO_DOCUMENTS_COLLECTION:[
+        {'keys':[('acl_id', pymongo.ASCENDING)], 'name':'acl_id_unique', 'unique':True}]}
+
+STORAGE_CODECS = ('none', 'gzip', 'zstd')
+STORAGE_CODEC = os.getenv('MONGO_STORAGE_CODEC', 'none')
+STORAGE_CODEC_FIELDS = os.getenv('MONGO_STORAGE_CODEC_FIELDS', 'grobid').split(',')
+STORAGE_CODEC_LEVELS = {'gzip':6, 'zstd':10}
+STORAGE_GRIDFS_THRESHOLD = int(os.getenv('MONGO_GRIDFS_THRESHOLD', 4 * 2**20)) # bytes, 0 to disable
+STORAGE_GRIDFS_FIELDS = os.getenv('MONGO_GRIDFS_FIELDS', 'grobid').split(',')
+
 def connect_mongo():
     """
         Connect to mongodb server.
@@ -88,12 +114,73 @@ def get_collection(db, name):
         if name not in db.list_collection_names():
             raise
         logger.debug(f'collection {name} found')
+        check_indexes(db[name])
         return db[name]    
     except Exception as e:
         logger.exception(f'collection  `{name}` not found')
         sys.exit()
 
 
+def check_indexes(collection, indexes=MONGO_INDEXES):
+    """
+        Check that expected indexes of a collection exist.
+        Log a warning for each missing index (run setup_db.py to create them).
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection, collection to check.
+        indexes : dict, default=MONGO_INDEXES, collection name -> expected indexes.
+
+        Returns
+        -------
+        missing : list[str], names of missing indexes.
+    """
+    existing = collection.index_information()
+    missing = [index['name'] for index in indexes.get(collection.name, []) if index['name'] not in existing]
+    for name in missing:
+        logger.warning(f'index `{name}` of collection `{collection.name}` is missing. Run `python tools/setup_db.py` to create it')
+    return missing
+
+
+def ensure_indexes(db, indexes=MONGO_INDEXES):
+    """
+        Create collections and their indexes if they don't exist.
+        Log any errors.
+
+        Parameters
+        ----------
+        db : pymongo.database.Database, mongodb database with an active connection.
+        indexes : dict, default=MONGO_INDEXES, collection name -> indexes to create.
+
+        Returns
+        -------
+        created : list[str], `collection.index` names of created indexes.
+    """
+    created = []
+    try:
+        for name, collection_indexes in indexes.items():
+            if name not in db.list_collection_names():
+                db.create_collection(name)
+                logger.info(f'collection {name} created')
+            existing = db[name].index_information()
+            for index in collection_indexes:
+                if index['name'] in existing:
+                    continue
+                options = {key:value for key, value in index.items() if key != 'keys'}
+                db[name].create_index(index['keys'], **options)
+                created.append(f'{name}.{index["name"]}')
+                logger.info(f'index {index["name"]} of collection {name} created')
+        return created
+    except Exception as e:
+        logger.exception(f'failure during indexes creation of database {db.name}')
+        sys.exit()
+
+
+def optional_kwargs(**kwargs):
+    # arguments left to None are not passed, pymongo compatible backends (mongomock) may not accept them
+    return {name:value for name, value in kwargs.items() if value is not None}
+
+
 def add_meta_date(to_add):
     timestamp = datetime.now().timestamp()
     to_add.update({'insert_date':timestamp, 'last_update_date':timestamp})
@@ -102,24 +189,274 @@ def add_meta_date(to_add):
 
 def update_meta_date(to_update):
     timestamp = datetime.now().timestamp()
-    if '$set' not in to_update:
-        to_update['$set'].update({'last_update_date':timestamp}) 
+    to_update.setdefault('$set', {}).update({'last_update_date':timestamp})
     return to_update
 
 
+def upsert_meta_date(to_upsert):
+    timestamp = datetime.now().timestamp()
+    if set(to_upsert.keys()) <= {'$setOnInsert'}: # insert only upsert, leave existing documents untouched
+        to_upsert.setdefault('$setOnInsert', {}).update({'insert_date':timestamp, 'last_update_date':timestamp})
+    else:
+        to_upsert.setdefault('$setOnInsert', {}).update({'insert_date':timestamp})
+        to_upsert.setdefault('$set', {}).update({'last_update_date':timestamp})
+    return to_upsert
+
+
+def compress(data, codec):
+    """
+        Compress bytes with given storage codec.
+
+        Parameters
+        ----------
+        data : bytes, data to compress.
+        codec : str, storage codec (`gzip` or `zstd`).
+
+        Returns
+        -------
+        data : bytes, compressed data.
+    """
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=STORAGE_CODEC_LEVELS['gzip'], mtime=0)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd storage codec needs `zstandard` package')
+        return zstandard.ZstdCompressor(level=STORAGE_CODEC_LEVELS['zstd']).compress(data)
+    raise ValueError(f'unknown storage codec `{codec}`')
+
+
+def decompress(data, codec):
+    """
+        Decompress bytes with given storage codec.
+
+        Parameters
+        ----------
+        data : bytes, data to decompress.
+        codec : str, storage codec (`gzip` or `zstd`).
+
+        Returns
+        -------
+        data : bytes, decompressed data.
+    """
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd storage codec needs `zstandard` package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f'unknown storage codec `{codec}`')
+
+
+def encode_document(document, codec=STORAGE_CODEC, fields=STORAGE_CODEC_FIELDS):
+    """
+        Compress document fields as BSON Binary.
+        str fields are utf-8 encoded, dict fields are BSON encoded.
+        Encoding of each field is recorded in `_storage` so `decode_document` can restore it.
+
+        Parameters
+        ----------
+        document : dict, document to encode.
+        codec : str, default=STORAGE_CODEC, storage codec (`none`, `gzip` or `zstd`).
+        fields : list[str], default=STORAGE_CODEC_FIELDS, fields to compress.
+
+        Returns
+        -------
+        document : dict, encoded copy of document (document itself if nothing to encode).
+    """
+    if codec == 'none' or not any(isinstance(document.get(field), (str, dict)) for field in fields):
+        return document
+    document = dict(document)
+    storage = dict(document.get('_storage', {}))
+    for field in fields:
+        value = document.get(field)
+        if isinstance(value, str):
+            document[field] = Binary(compress(value.encode('utf-8'), codec))
+            storage[field] = {'codec':codec, 'type':'str'}
+        elif isinstance(value, dict):
+            document[field] = Binary(compress(bson.encode(value), codec))
+            storage[field] = {'codec':codec, 'type':'bson'}
+    document['_storage'] = storage
+    return document
+
+
+def get_fs(collection):
+    """
+        Get GridFS bucket of a collection, used to offload oversized fields.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection, collection owning offloaded fields.
+
+        Returns
+        -------
+        fs : gridfs.GridFS, GridFS bucket `<collection>_fs`.
+    """
+    return gridfs.GridFS(collection.database, collection=f'{collection.name}_fs')
+
+
+def gridfs_files(document):
+    """
+        File ids of the fields of a document offloaded to GridFS (see `offload_document`).
+    """
+    return [document[field] for field, info in document.get('_storage', {}).items() if info.get('gridfs') and field in document]
+
+
+def delete_files(collection, file_ids):
+    """
+        Delete GridFS files of a collection, missing files are ignored.
+        GridFS does not support transactions : files are deleted without session, after (not in) the transaction.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection, collection owning offloaded fields.
+        file_ids : iterable of ObjectId, ids of files to delete.
+    """
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    fs = get_fs(collection)
+    for file_id in file_ids:
+        fs.delete(file_id)
+
+
+def find_replaced_files(documents, collection, key='acl_id', gridfs_threshold=STORAGE_GRIDFS_THRESHOLD, session=None):
+    """
+        GridFS files of stored documents that an upsert of `documents` replaces.
+        With GridFS disabled (`gridfs_threshold` 0), stored documents are expected to have no offloaded field
+        (see `migrate_documents.py compress`) and nothing is read.
+
+        Parameters
+        ----------
+        documents : list[dict], documents to upsert, each with a `key` field.
+        collection : pymongo.collection.Collection, collection to write.
+        key : str, default='acl_id', unique field identifying documents.
+        gridfs_threshold : int, default=STORAGE_GRIDFS_THRESHOLD, size in bytes above which a field is offloaded.
+        session : pymongo.client_session.ClientSession, default=None, session to read with.
+
+        Returns
+        -------
+        replaced_files : dict, key -> ids of files of the stored document.
+    """
+    if gridfs_threshold <= 0 or not documents:
+        return {}
+    offloaded_filter = {key:{'$in':[document[key] for document in documents]}, '$or':[{f'_storage.{field}.gridfs':True} for field in STORAGE_GRIDFS_FIELDS]}
+    projection = {key:1, '_storage':1, **{field:1 for field in STORAGE_GRIDFS_FIELDS}}
+    return {previous[key]:gridfs_files(previous) for previous in collection.find(offloaded_filter, projection=projection, session=session)}
+
+
+def failed_operations(error, count, ordered):
+    """
+        Indexes of the operations of a bulk write (or insert_many) not applied because of `error`.
+
+        Parameters
+        ----------
+        error : Exception, exception raised by the write.
+        count : int, count of operations.
+        ordered : bool, was the write ordered (stops at first error).
+
+        Returns
+        -------
+        failed : set of int, indexes of operations not applied (all of them if error is not a BulkWriteError).
+    """
+    if not isinstance(error, pymongo.errors.BulkWriteError):
+        return set(range(count))
+    errors = [write_error['index'] for write_error in error.details.get('writeErrors', [])]
+    return set(range(min(errors), count)) if ordered and errors else set(errors)
+
+
+def offload_document(document, collection, threshold=STORAGE_GRIDFS_THRESHOLD, fields=STORAGE_GRIDFS_FIELDS):
+    """
+        Move fields bigger than threshold (once encoded) to GridFS, keeping their file id in document.
+        Offloading is recorded in `_storage` so `decode_document` can resolve it.
+        GridFS does not support transactions : files are written without session, before the document write
+        (and before its transaction). Callers delete them (see `delete_files`) if the document is not written.
+
+        Parameters
+        ----------
+        document : dict, document to offload (output of `encode_document`).
+        collection : pymongo.collection.Collection, collection where document will be stored.
+        threshold : int, default=STORAGE_GRIDFS_THRESHOLD, size in bytes above which a field is offloaded, 0 to disable.
+        fields : list[str], default=STORAGE_GRIDFS_FIELDS, fields to offload.
+
+        Returns
+        -------
+        document : dict, offloaded copy of document (document itself if nothing to offload).
+    """
+    if threshold <= 0:
+        return document
+    storage = dict(document.get('_storage', {}))
+    offloaded = {}
+    for field in fields:
+        value = document.get(field)
+        if field in storage and isinstance(value, bytes) and not storage[field].get('gridfs'):
+            data, info = bytes(value), storage[field]
+        elif isinstance(value, str):
+            data, info = value.encode('utf-8'), {'codec':'none', 'type':'str'}
+        elif isinstance(value, dict):
+            data, info = bson.encode(value), {'codec':'none', 'type':'bson'}
+        else:
+            continue
+        if len(data) > threshold:
+            offloaded[field] = get_fs(collection).put(data, filename=f'{document.get("acl_id")}.{field}', metadata={'acl_id':document.get('acl_id'), 'field':field})
+            storage[field] = dict(info, gridfs=True)
+            logger.debug(f'offload {field} of {document.get("acl_id")} to GridFS ({len(data)} bytes)')
+    if not offloaded:
+        return document
+    return {**document, **offloaded, '_storage':storage}
+
+
+def decode_document(document, collection=None):
+    """
+        Restore fields compressed by `encode_document` or offloaded by `offload_document`.
+        Offloaded fields are only read from GridFS here, for projected fields.
+        Documents without `_storage` are returned unchanged.
+
+        Parameters
+        ----------
+        document : dict, document read from a collection.
+        collection : pymongo.collection.Collection, default=None, collection of document, needed to resolve offloaded fields.
+
+        Returns
+        -------
+        document : dict, decoded document (without `_storage`).
+    """
+    if '_storage' not in document:
+        return document
+    storage = document.pop('_storage')
+    for field, info in storage.items():
+        if field not in document: # field not projected
+            continue
+        if info.get('gridfs'):
+            if collection is None:
+                raise ValueError(f'field `{field}` is stored in GridFS, its collection is needed to resolve it')
+            data = get_fs(collection).get(document[field]).read()
+        else:
+            data = bytes(document[field])
+        data = decompress(data, info['codec']) if info['codec'] != 'none' else data
+        document[field] = data.decode('utf-8') if info['type'] == 'str' else bson.decode(data)
+    return document
+
+
 def insert_one(
     document: dict,
     collection: pymongo.collection.Collection,
     bypass_document_validation: bool = False, 
     session: Optional[ClientSession] = None, 
-    comment: Optional[Any] = None
+    comment: Optional[Any] = None,
+    codec: str = STORAGE_CODEC,
+    gridfs_threshold: int = STORAGE_GRIDFS_THRESHOLD
     ):
 
-    collection.insert_one(
-        add_meta_date(document), 
-        bypass_document_validation=bypass_document_validation, 
-        session=session, 
-        comment=comment)
+    document = offload_document(encode_document(document, codec), collection, gridfs_threshold)
+    try:
+        collection.insert_one(
+            add_meta_date(document), 
+            bypass_document_validation=bypass_document_validation, 
+            session=session, 
+            **optional_kwargs(comment=comment))
+    except Exception:
+        delete_files(collection, gridfs_files(document))
+        raise
 
 
 def insert_many(
@@ -128,15 +465,117 @@ def insert_many(
     ordered: bool = True, 
     bypass_document_validation: bool = False, 
     session: Optional[ClientSession] = None, 
-    comment: Optional[Any] = None
+    comment: Optional[Any] = None,
+    codec: str = STORAGE_CODEC,
+    gridfs_threshold: int = STORAGE_GRIDFS_THRESHOLD
     ):
     
-    collection.insert_many(
-        [add_meta_date(document) for document in documents],
-        ordered = ordered,
-        bypass_document_validation=bypass_document_validation, 
-        session=session, 
-        comment=comment)
+    documents = [add_meta_date(document) for document in encode_documents(documents, collection, codec, gridfs_threshold)]
+    try:
+        collection.insert_many(
+            documents,
+            ordered = ordered,
+            bypass_document_validation=bypass_document_validation, 
+            session=session, 
+            **optional_kwargs(comment=comment))
+    except Exception as e:
+        delete_files(collection, [file_id for i in failed_operations(e, len(documents), ordered) for file_id in gridfs_files(documents[i])])
+        raise
+
+
+def encode_documents(documents, collection, codec=STORAGE_CODEC, gridfs_threshold=STORAGE_GRIDFS_THRESHOLD):
+    """
+        Encode documents (see `encode_document`) and offload their oversized fields to GridFS (see `offload_document`).
+        Files are written here, outside of any transaction : delete them (`delete_files` of `gridfs_files`)
+        if documents are not written.
+
+        Parameters
+        ----------
+        documents : list[dict], documents to encode.
+        collection : pymongo.collection.Collection, collection where documents will be stored.
+        codec : str, default=STORAGE_CODEC, storage codec of documents fields.
+        gridfs_threshold : int, default=STORAGE_GRIDFS_THRESHOLD, size in bytes above which a field is offloaded.
+
+        Returns
+        -------
+        documents : list[dict], encoded documents.
+    """
+    return [offload_document(encode_document(document, codec), collection, gridfs_threshold) for document in documents]
+
+
+def upsert_many(
+    documents: List[Dict],
+    collection: pymongo.collection.Collection,
+    key: str = 'acl_id',
+    ordered: bool = False,
+    session: Optional[ClientSession] = None,
+    codec: str = STORAGE_CODEC,
+    gridfs_threshold: int = STORAGE_GRIDFS_THRESHOLD,
+    encoded: bool = False
+    ):
+    """
+        Idempotent insert_many : upsert each document by `key` in a single bulk write.
+        Writing the same documents twice leaves one document by key.
+        GridFS files of replaced offloaded fields are deleted once documents are written, files of documents
+        not written are deleted on failure (see `find_replaced_files`).
+        GridFS does not support transactions : in a transaction, documents must be encoded beforehand
+        (`encode_documents`), and their files deleted by the caller once the transaction is committed or aborted
+        (see `update_documents.write_batch`).
+
+        Parameters
+        ----------
+        documents : list[dict], documents to upsert, each with a `key` field.
+        collection : pymongo.collection.Collection, collection to write.
+        key : str, default='acl_id', unique field identifying documents.
+        ordered : bool, default=False, stop at first error.
+        session : pymongo.client_session.ClientSession, default=None, session (transaction) to use.
+        codec : str, default=STORAGE_CODEC, storage codec of documents fields.
+        gridfs_threshold : int, default=STORAGE_GRIDFS_THRESHOLD, size in bytes above which a field is offloaded.
+        encoded : bool, default=False, are documents already encoded (output of `encode_documents`).
+
+        Returns
+        -------
+        result : pymongo.results.BulkWriteResult, bulk write result.
+    """
+    in_transaction = session is not None and session.in_transaction
+    if in_transaction and not encoded:
+        raise ValueError('documents upserted in a transaction must be encoded beforehand (encode_documents), GridFS does not support transactions')
+    documents = documents if encoded else encode_documents(documents, collection, codec, gridfs_threshold)
+    operations = []
+    for document in documents:
+        update = {'$set':{field:value for field, value in document.items() if field not in (key, '_id')}}
+        if '_storage' not in document: # stale encoding of a previous write
+            update['$unset'] = {'_storage':''}
+        operations.append(UpdateOne({key:document[key]}, update, upsert=True))
+    if in_transaction: # files are handled by the caller, around the transaction
+        return bulk_write(operations, collection, ordered=ordered, session=session)
+
+    replaced_files = find_replaced_files(documents, collection, key, gridfs_threshold, session)
+    try:
+        result = bulk_write(operations, collection, ordered=ordered, session=session)
+    except Exception as e:
+        failed = failed_operations(e, len(operations), ordered)
+        delete_files(collection, [file_id for i in failed for file_id in gridfs_files(documents[i])])
+        delete_files(collection, [file_id for i, document in enumerate(documents) if i not in failed for file_id in replaced_files.get(document[key], [])])
+        raise
+    delete_files(collection, [file_id for file_ids in replaced_files.values() for file_id in file_ids])
+    return result
+
+
+def supports_transactions(client):
+    """
+        Check if mongodb deployment supports multi-document transactions (replica set or sharded cluster).
+
+        Parameters
+        ----------
+        client : pymongo.MongoClient, mongodb client with an active connection.
+
+        Returns
+        -------
+        supported : bool, are transactions supported.
+    """
+    topology = getattr(client, 'topology_description', None) # missing on mongomock clients
+    return topology is not None and topology.topology_type_name in ('ReplicaSetWithPrimary', 'Sharded')
 
 
 def update_one(
@@ -161,8 +600,46 @@ def update_one(
         array_filters=array_filters, 
         hint=hint, 
         session=session, 
-        let=let, 
-        comment=comment)
+        **optional_kwargs(let=let, comment=comment))
+
+
+def add_operation_meta_date(operation):
+    """
+        Stamp meta dates on a bulk write operation, in place.
+        InsertOne and ReplaceOne documents get `insert_date` and `last_update_date` like `add_meta_date`.
+        UpdateOne and UpdateMany get `last_update_date`, plus `insert_date` on upsert.
 
+        Parameters
+        ----------
+        operation : pymongo operation (InsertOne, UpdateOne, UpdateMany, ReplaceOne), operation to stamp.
+
+        Returns
+        -------
+        operation : pymongo operation, same operation with stamped document.
+    """
+    if isinstance(operation, (InsertOne, ReplaceOne)):
+        add_meta_date(operation._doc)
+    elif isinstance(operation, (UpdateOne, UpdateMany)) and isinstance(operation._doc, dict):
+        if operation._upsert:
+            upsert_meta_date(operation._doc)
+        else:
+            update_meta_date(operation._doc)
+    return operation
+
+
+def bulk_write(
+    requests: List[Any],
+    collection: pymongo.collection.Collection,
+    ordered: bool = True,
+    bypass_document_validation: bool = False,
+    session: Optional[ClientSession] = None,
+    comment: Optional[Any] = None,
+    let: Optional[Mapping] = None
+    ):
 
-# TODO : bulkWrite and use it in update_register and update_documents
\ No newline at end of file
+    return collection.bulk_write(
+        [add_operation_meta_date(request) for request in requests],
+        ordered=ordered,
+        bypass_document_validation=bypass_document_validation,
+        session=session,
+        **optional_kwargs(comment=comment, let=let))
\ No newline at end of file
@@ -0,0 +1,307 @@
+from array import array
+from itertools import chain
+from pathlib import Path
+from time import perf_counter
+
+import json
+import logging
+import os
+import shutil
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed by columnar format
+    np = None
+
+from helpers import iter_jsonl
+
+
+logger = logging.getLogger('columnar')
+
+
+COLUMNAR_SHARD_SIZE = int(os.getenv('COLUMNAR_SHARD_SIZE', 10000)) # documents by shard
+COLUMNAR_FORMAT_VERSION = 2
+COLUMNS = ('words', 'word_offsets', 'sentences', 'sentence_offsets', 'sections', 'section_offsets')
+TABLES = ('acl_ids', 'index_acl_ids', 'index_documents', 'vocab', 'vocab_offsets') # whole corpus tables
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('`numpy` is needed by columnar format (pip install numpy)')
+
+
+class ColumnarWriter:
+    """
+        Write tokenized documents (see `process_sample.process_doc`) in a columnar directory, usable as a context manager.
+        Words are stored as int32 vocabulary ids, sentences and sections as int32 [start, end] spans, all concatenated
+        by shard of `shard_size` documents, with int64 offset tables (`<column>_offsets[i]` is the start of document i).
+        Whole corpus tables are binary too, so a reader opens and finds a document without parsing anything but `meta.json` :
+        `acl_ids.npy` (utf-8 bytes, document order), the acl_id index `index_acl_ids.npy` (sorted) and `index_documents.npy`
+        (document of each sorted acl_id), and the vocabulary `vocab.npy` (utf-8 bytes of words, concatenated) with
+        `vocab_offsets.npy` (word i is `vocab[vocab_offsets[i]:vocab_offsets[i+1]]`).
+
+        Layout : `meta.json`, whole corpus tables and `shard-00000/` directories of `.npy` columns.
+
+        Parameters
+        ----------
+        path : str or Path, output directory. A previous columnar directory is replaced, other non-empty paths are refused.
+            Files are written in a `.part` directory, renamed on close (removed if the context exits with an error).
+        shard_size : int, default=COLUMNAR_SHARD_SIZE, documents by shard.
+    """
+
+    def __init__(self, path, shard_size=COLUMNAR_SHARD_SIZE):
+        require_numpy()
+        self.path = Path(path)
+        if self.path.exists() and not (self.path / 'meta.json').is_file() and (not self.path.is_dir() or any(self.path.iterdir())):
+            raise FileExistsError(f'{self.path} exists and is not a columnar directory')
+        self.shard_size = shard_size
+        self.part_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.part')
+        shutil.rmtree(self.part_path, ignore_errors=True)
+        self.part_path.mkdir(parents=True)
+        self.vocab = {}
+        self.acl_ids = []
+        self.shards = 0
+        self.count = 0
+        self.reset()
+
+    def reset(self):
+        self.shard_count = 0
+        self.columns = {'words':array('i'), 'sentences':array('i'), 'sections':array('i')} # spans flattened
+        self.offsets = {'words':array('q', [0]), 'sentences':array('q', [0]), 'sections':array('q', [0])}
+
+    def write(self, document):
+        self.columns['words'].extend(self.vocab.setdefault(word, len(self.vocab)) for word in document['words'])
+        self.offsets['words'].append(len(self.columns['words']))
+        for name in ('sentences', 'sections'):
+            self.columns[name].extend(chain.from_iterable(document[name]))
+            self.offsets[name].append(len(self.columns[name]) // 2)
+        self.acl_ids.append((document.get('acl_id') or '').encode('utf-8'))
+        self.shard_count += 1
+        self.count += 1
+        if self.shard_count >= self.shard_size:
+            self.flush()
+
+    def write_many(self, documents):
+        for document in documents:
+            self.write(document)
+
+    def flush(self):
+        if not self.shard_count:
+            return
+        shard_path = self.part_path / f'shard-{self.shards:05d}'
+        shard_path.mkdir()
+        np.save(shard_path / 'words.npy', np.frombuffer(self.columns['words'], dtype=np.int32))
+        for name in ('sentences', 'sections'):
+            np.save(shard_path / f'{name}.npy', np.frombuffer(self.columns[name], dtype=np.int32).reshape(-1, 2))
+        for name in ('words', 'sentences', 'sections'):
+            np.save(shard_path / f'{name[:-1]}_offsets.npy', np.frombuffer(self.offsets[name], dtype=np.int64))
+        self.shards += 1
+        self.reset()
+
+    def close(self):
+        self.flush()
+        acl_ids = np.array(self.acl_ids, dtype=bytes) if self.acl_ids else np.zeros(0, dtype='S1')
+        order = np.argsort(acl_ids, kind='stable')
+        np.save(self.part_path / 'acl_ids.npy', acl_ids)
+        np.save(self.part_path / 'index_acl_ids.npy', acl_ids[order])
+        np.save(self.part_path / 'index_documents.npy', order.astype(np.int64))
+        words = [word.encode('utf-8') for word in self.vocab] # dict keeps ids order
+        offsets = array('q', [0])
+        for word in words:
+            offsets.append(offsets[-1] + len(word))
+        np.save(self.part_path / 'vocab.npy', np.frombuffer(b''.join(words), dtype=np.uint8))
+        np.save(self.part_path / 'vocab_offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+        meta = {'version':COLUMNAR_FORMAT_VERSION, 'documents':self.count, 'shards':self.shards, 'shard_size':self.shard_size, 'vocab_size':len(words)}
+        (self.part_path / 'meta.json').write_text(json.dumps(meta), encoding='utf-8') # written last : marks a complete directory
+        if self.path.exists(): # previous columnar directory, or empty directory
+            shutil.rmtree(self.path)
+        self.part_path.rename(self.path)
+
+    def abort(self):
+        shutil.rmtree(self.part_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ColumnarReader:
+    """
+        Read a columnar directory written by `ColumnarWriter`. Columns and tables are memory-mapped (`np.load(mmap_mode='r')`)
+        on first use, so opening is instant and documents are read without copying nor parsing : `get(acl_id)` is a binary
+        search in the sorted acl_id index, and only words of read documents are decoded (whole vocabulary by `vocab`).
+
+        Parameters
+        ----------
+        path : str or Path, columnar directory.
+    """
+
+    def __init__(self, path):
+        require_numpy()
+        self.path = Path(path)
+        self.meta = json.loads((self.path / 'meta.json').read_text(encoding='utf-8'))
+        if self.meta['version'] != COLUMNAR_FORMAT_VERSION:
+            raise ValueError(f'{self.path} is in columnar format version {self.meta["version"]}, convert it again (version {COLUMNAR_FORMAT_VERSION})')
+        self.shard_size = self.meta['shard_size']
+        self.shards = {}
+        self.tables = {}
+        self._vocab = None
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = np.load(self.path / f'{name}.npy', mmap_mode='r')
+        return self.tables[name]
+
+    @property
+    def vocab(self):
+        # whole vocabulary (id -> word), decoded on first use
+        if self._vocab is None:
+            data, offsets = self.table('vocab').tobytes(), self.table('vocab_offsets').tolist()
+            self._vocab = [data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+        return self._vocab
+
+    def decode(self, ids):
+        """
+            Words of vocabulary ids, read from the memory-mapped vocabulary unless it is already decoded.
+        """
+        if self._vocab is not None:
+            return [self._vocab[i] for i in ids]
+        data, offsets = self.table('vocab'), self.table('vocab_offsets')
+        return [data[offsets[i]:offsets[i+1]].tobytes().decode('utf-8') for i in ids]
+
+    def index(self, acl_id):
+        """
+            Index of the (first) document of an acl_id, None if missing.
+        """
+        keys, key = self.table('index_acl_ids'), acl_id.encode('utf-8')
+        if not key or len(key) > keys.dtype.itemsize: # longer keys would be truncated by searchsorted
+            return None
+        i = int(np.searchsorted(keys, key))
+        return int(self.table('index_documents')[i]) if i < len(keys) and keys[i] == key else None
+
+    def shard(self, shard):
+        if shard not in self.shards:
+            shard_path = self.path / f'shard-{shard:05d}'
+            self.shards[shard] = {name:np.load(shard_path / f'{name}.npy', mmap_mode='r') for name in COLUMNS}
+        return self.shards[shard]
+
+    def __len__(self):
+        return self.meta['documents']
+
+    def __getitem__(self, index):
+        return self.document(index)
+
+    def __iter__(self):
+        self.vocab # every word is read
+        for index in range(len(self)):
+            yield self.document(index)
+
+    def document(self, index, decode=True):
+        """
+            Read a document.
+
+            Parameters
+            ----------
+            index : int, document index (in writing order).
+            decode : bool, default=True, return words as strings, vocabulary ids (memory-mapped array) otherwise.
+
+            Returns
+            -------
+            document : dict, `acl_id`, `sections` and `sentences` ([start, end] arrays) and `words`.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(f'document index {index} out of range')
+        columns = self.shard(index // self.shard_size)
+        i = index % self.shard_size
+        document = {'acl_id':self.table('acl_ids')[index].decode('utf-8') or None}
+        for name in ('words', 'sentences', 'sections'):
+            offsets = columns[f'{name[:-1]}_offsets']
+            document[name] = columns[name][offsets[i]:offsets[i+1]]
+        if decode:
+            document['words'] = self.decode(document['words'].tolist())
+        return document
+
+    def get(self, acl_id, decode=True):
+        """
+            Read a document by acl_id, None if missing.
+        """
+        index = self.index(acl_id)
+        return None if index is None else self.document(index, decode)
+
+
+def jsonl_to_columnar(input_path, output_path, shard_size=COLUMNAR_SHARD_SIZE):
+    """
+        Convert a jsonl output of `process_sample.py` in columnar format.
+
+        Returns
+        -------
+        count : int, converted documents count.
+    """
+    with ColumnarWriter(output_path, shard_size) as writer:
+        writer.write_many(iter_jsonl(input_path))
+    return writer.count
+
+
+def directory_size(path):
+    return sum(file.stat().st_size for file in Path(path).rglob('*') if file.is_file())
+
+
+def compare_formats(jsonl_path, columnar_path):
+    """
+        Compare size on disk and full load time (every document with its words) of jsonl and columnar outputs,
+        and check their documents are identical.
+
+        Returns
+        -------
+        results : dict, format -> size in bytes and load time in seconds.
+    """
+    t = perf_counter()
+    documents = list(iter_jsonl(jsonl_path))
+    results = {'jsonl':{'size':Path(jsonl_path).stat().st_size, 'load':perf_counter() - t}}
+
+    t = perf_counter()
+    reader = ColumnarReader(columnar_path)
+    columnar = [reader.document(i, decode=False) for i in range(len(reader))]
+    results['columnar'] = {'size':directory_size(columnar_path), 'load':perf_counter() - t}
+
+    t = perf_counter()
+    decoded = list(reader)
+    results['columnar (decoded words)'] = {'size':results['columnar']['size'], 'load':perf_counter() - t}
+
+    differences = sum(
+        document['words'] != other['words'] or document['sentences'] != other['sentences'].tolist() or document['sections'] != other['sections'].tolist()
+        for document, other in zip(documents, decoded))
+    if differences or len(documents) != len(decoded):
+        logger.error(f'{differences} documents differ between {jsonl_path} and {columnar_path}')
+    for name, result in results.items():
+        logger.info(f'{name} : {result["size"]/2**20:.1f} MB, {len(columnar)} documents loaded in {result["load"]:.3f}s')
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from logging import config
+    config.fileConfig('logging.conf')
+
+    parser = argparse.ArgumentParser(description='Convert or compare tokenized documents in columnar format.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='convert a jsonl output of process_sample.py')
+    convert_parser.add_argument('input', help='jsonl file (.jsonl, .jsonl.gz or .jsonl.zst)')
+    convert_parser.add_argument('output', help='columnar directory')
+    convert_parser.add_argument('--shard-size', type=int, default=COLUMNAR_SHARD_SIZE, help='documents by shard')
+    compare_parser = subparsers.add_parser('compare', help='compare size and load time of jsonl and columnar outputs')
+    compare_parser.add_argument('input', help='jsonl file')
+    compare_parser.add_argument('output', help='columnar directory')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        count = jsonl_to_columnar(args.input, args.output, args.shard_size)
+        logger.info(f'{count} documents converted to {args.output}')
+    else:
+        compare_formats(args.input, args.output)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from metrics import metrics
+
+
+logger = logging.getLogger('fileCache')
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    """
+        Compute sha256 hexdigest of a file, chunk by chunk.
+
+        Parameters
+        ----------
+        path : Path, path of file to hash.
+        chunk_size : int, default=1 MB, size in bytes of read chunks.
+
+        Returns
+        -------
+        digest : str, sha256 hexdigest.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class FileCache:
+    """
+        Persistent on-disk cache of files, keyed by `namespace/key`, with a size cap and LRU eviction.
+        Files are written atomically and their modification time is used as LRU clock (touched on hit),
+        so the order survives restarts. Small refs (`name -> key`) point to content addressed files.
+
+        Parameters
+        ----------
+        root : str or Path, cache directory.
+        max_bytes : int, maximum total size of cached files, 0 to disable cache.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # relative path -> size, least recently used first
+        self.size = 0
+        if self.enabled:
+            self.root.mkdir(parents=True, exist_ok=True)
+            files = [path for path in self.root.glob('*/*/*') if path.is_file() and not path.name.endswith('.part')]
+            for path in sorted(files, key=lambda path: path.stat().st_mtime):
+                size = path.stat().st_size
+                self.entries[str(path.relative_to(self.root))] = size
+                self.size += size
+            logger.debug(f'file cache {self.root} loaded : {len(self.entries)} files, {self.size} bytes')
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, namespace, key):
+        return self.root / namespace / key[:2] / key
+
+    def get(self, namespace, key):
+        """
+            Get path of a cached file and mark it as recently used.
+
+            Returns
+            -------
+            path : Path or None, path of cached file, None on miss.
+        """
+        if not self.enabled:
+            return None
+        path = self.path(namespace, key)
+        relative = str(path.relative_to(self.root))
+        with self.lock:
+            hit = relative in self.entries and path.is_file()
+            if hit:
+                self.entries.move_to_end(relative)
+        try:
+            if hit:
+                os.utime(path)
+        except OSError: # evicted meanwhile by another process
+            hit = False
+        metrics.inc('file_cache_requests_total', labels={'namespace':namespace, 'result':'hit' if hit else 'miss'})
+        return path if hit else None
+
+    def put(self, namespace, key, src=None, data=None):
+        """
+            Copy a file (`src`) or bytes (`data`) in cache, then evict least recently used files above `max_bytes`.
+
+            Returns
+            -------
+            path : Path or None, path of cached file, None if cache is disabled.
+        """
+        if not self.enabled:
+            return None
+        path = self.path(namespace, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.part')
+        if src is not None:
+            shutil.copyfile(src, part_path)
+        else:
+            part_path.write_bytes(data)
+        os.replace(part_path, path)
+        relative = str(path.relative_to(self.root))
+        with self.lock:
+            self.size += path.stat().st_size - self.entries.pop(relative, 0)
+            self.entries[relative] = path.stat().st_size
+            self.evict()
+        return path
+
+    def evict(self):
+        # called with lock held
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            relative, size = self.entries.popitem(last=False)
+            (self.root / relative).unlink(missing_ok=True)
+            self.size -= size
+            metrics.inc('file_cache_evictions_total')
+            logger.debug(f'file cache {self.root} evicted {relative} ({size} bytes)')
+
+    def get_ref(self, name):
+        """
+            Read a ref (`name -> key`), None if missing.
+        """
+        path = self.root / 'refs' / hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return path.read_text(encoding='utf-8') if self.enabled and path.is_file() else None
+
+    def set_ref(self, name, key):
+        """
+            Write a ref (`name -> key`) atomically.
+        """
+        if not self.enabled:
+            return
+        path = self.root / 'refs' / hashlib.sha256(name.encode('utf-8')).hexdigest()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.part')
+        part_path.write_text(key, encoding='utf-8')
+        os.replace(part_path, path)
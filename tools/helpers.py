@@ -1,6 +1,129 @@
+from itertools import islice
 from pathlib import Path
+import codecs
+import gzip
+import io
 import json
 
+try:
+    import orjson
+except ImportError: # optional faster json backend
+    orjson = None
+
+try:
+    import zstandard
+except ImportError: # .zst files need zstandard
+    zstandard = None
+
+JSONL_BUFFER_SIZE = 1024 * 1024
+JSONL_SUFFIXES = ('.jsonl', '.jsonl.gz', '.jsonl.zst')
+
+def dumps(item):
+    """
+        Serialize an item to json bytes, with orjson when installed (json for what orjson does not support)
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(item)
+        except TypeError:
+            pass
+    return json.dumps(item).encode('utf-8')
+
+def loads(line):
+    """
+        Deserialize json bytes or str, with orjson when installed
+    """
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+def open_binary(path, mode='rb', buffer_size=JSONL_BUFFER_SIZE):
+    """
+        Open a file in binary mode, transparently (de)compressed according to its suffix (`.gz` or `.zst`)
+
+        Parameters
+        ----------
+        path : str or Path, path of file.
+        mode : str, default='rb', `rb`, `wb` or `ab`.
+        buffer_size : int, default=JSONL_BUFFER_SIZE, size in bytes of io buffer.
+    """
+    path = Path(path)
+    if path.suffix == '.gz':
+        return gzip.open(path, mode, compresslevel=6)
+    if path.suffix == '.zst':
+        if zstandard is None:
+            raise ImportError(f'`zstandard` is needed to read or write {path}')
+        f = open(path, mode, buffering=buffer_size)
+        if 'r' in mode:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True), buffer_size)
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+    return open(path, mode, buffering=buffer_size)
+
+def iter_jsonl(path, encoding='utf-8'):
+    """
+        Read a jsonl file (optionally `.gz` or `.zst` compressed) line by line
+
+        Parameters
+        ----------
+        path : str or Path, path of data to read
+        encoding : str, default='utf-8', encoding format to read.
+
+        Returns
+        -------
+        items : generator of deserialized lines, empty lines are skipped.
+    """
+    with open_binary(path, 'rb') as f:
+        lines = f if encoding == 'utf-8' else io.TextIOWrapper(f, encoding=encoding)
+        for line in lines:
+            if line.strip():
+                yield loads(line)
+
+class JsonlWriter:
+    """
+        Buffered jsonl writer (optionally `.gz` or `.zst` compressed), one item at a time, usable as a context manager
+
+        Parameters
+        ----------
+        path : str or Path, path of data to write
+        append : bool, default=False, append to an existing file instead of overwriting it.
+        buffer_size : int, default=JSONL_BUFFER_SIZE, size in bytes of serialized items kept before writing them.
+        encoding : str, default='utf-8', encoding format to write.
+    """
+
+    def __init__(self, path, append=False, buffer_size=JSONL_BUFFER_SIZE, encoding='utf-8'):
+        appended = append and Path(path).is_file() and Path(path).stat().st_size > 0
+        self.file = open_binary(path, 'ab' if append else 'wb', buffer_size)
+        self.buffer_size = buffer_size
+        self.encoder = None if encoding == 'utf-8' else codecs.getincrementalencoder(encoding)() # single BOM for utf-16 ...
+        if self.encoder is not None and appended:
+            self.encoder.setstate(0) # BOM already written at the start of the file
+        self.buffer, self.buffered = [], 0
+        self.count = 0
+
+    def write(self, item):
+        line = dumps(item) + b'\n' if self.encoder is None else self.encoder.encode(json.dumps(item) + '\n')
+        self.buffer.append(line)
+        self.buffered += len(line)
+        self.count += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_many(self, items):
+        for item in items:
+            self.write(item)
+
+    def flush(self):
+        self.file.write(b''.join(self.buffer))
+        self.buffer, self.buffered = [], 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 def read_jsonl(path, encoding='utf-8'):
     """
         Shortcut for read jsonl file
@@ -10,17 +133,39 @@ def read_jsonl(path, encoding='utf-8'):
         path : str or Path, path of data to read
         encoding : str, default='utf-8', encoding format to read.
     """
-    path = Path(path) if isinstance(path, str) else path
-    return [json.loads(line) for line in path.read_text(encoding=encoding).strip().split('\n')]
+    return list(iter_jsonl(path, encoding))
 
 def write_jsonl(path, data, encoding='utf-8'):
     """
-        Shortcut for write jsonl file
+        Shortcut for write jsonl file, items are serialized and written one at a time
 
         Parameters
         ----------
         path : str or Path, path of data to read
+        data : iterable of items to write
         encoding : str, default='utf-8', encoding format to write.
+
+        Returns
+        -------
+        count : int, count of written items.
+    """
+    with JsonlWriter(path, encoding=encoding) as writer:
+        writer.write_many(data)
+    return writer.count
+
+def chunked(iterable, size):
+    """
+        Split an iterable in consecutive chunks of given size.
+
+        Parameters
+        ----------
+        iterable : iterable, items to split.
+        size : int, maximum size of each chunk.
+
+        Returns
+        -------
+        chunks : generator of list, consecutive chunks of items.
     """
-    path = Path(path) if isinstance(path, str) else path
-    path.write_text('\n'.join([json.dumps(item) for item in data]), encoding=encoding)
\ No newline at end of file
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -0,0 +1,196 @@
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from metrics import metrics
+
+
+logger = logging.getLogger('httpHelpers')
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+        Thread safe token bucket rate limiter.
+        `acquire` blocks until a token is available.
+
+        Parameters
+        ----------
+        rate : float, tokens added by second (requests by second allowed in the long run).
+        capacity : float, default=1, maximum tokens stored (allowed burst size).
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0: # no limit
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostSemaphores:
+    """
+        Thread safe per host concurrency limiter.
+        `hold(url)` blocks until one of the `limit` slots of url host is free.
+
+        Parameters
+        ----------
+        limit : int, maximum concurrent requests by host.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.limit))
+        with semaphore:
+            yield
+
+
+def make_session(pool_size=10, headers=None):
+    """
+        Create a requests session with a connection pool sized for `pool_size` concurrent workers.
+
+        Parameters
+        ----------
+        pool_size : int, default=10, maximum connections kept by host.
+        headers : dict, default=None, headers sent with every request.
+
+        Returns
+        -------
+        session : requests.Session, session with pooled connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def retry_after(res):
+    """
+        Read `Retry-After` header of a response (delay in seconds or http date).
+
+        Parameters
+        ----------
+        res : requests.Response, response to read.
+
+        Returns
+        -------
+        delay : float or None, seconds to wait, None if header is missing or invalid.
+    """
+    value = res.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=1., cap=60.):
+    """
+        Exponential backoff delay with full jitter.
+
+        Parameters
+        ----------
+        attempt : int, count of failed attempts (from 1).
+        base : float, default=1., delay in seconds of first retry.
+        cap : float, default=60., maximum delay in seconds.
+
+        Returns
+        -------
+        delay : float, seconds to wait.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def request_with_retry(session, method, url, limiter=None, max_retries=5, backoff=1., retry_status_codes=RETRY_STATUS_CODES, **kwargs):
+    """
+        Send an http(s) request, retrying on retryable status codes and connection errors.
+        Each attempt waits for a `limiter` token. `Retry-After` is honoured, otherwise exponential backoff with jitter is used.
+        Status codes, errors, retries and latency (until headers for streamed responses) are recorded in metrics by host.
+        Last response is returned even if its status code is retryable, last exception is raised if every attempt failed.
+
+        Parameters
+        ----------
+        session : requests.Session, session to use.
+        method : str, http method.
+        url : str, http(s) url to request.
+        limiter : TokenBucket, default=None, rate limiter shared by concurrent workers.
+        max_retries : int, default=5, maximum retries after first attempt.
+        backoff : float, default=1., delay in seconds of first retry when no `Retry-After` is given.
+        retry_status_codes : tuple of int, default=RETRY_STATUS_CODES, status codes to retry.
+        **kwargs : arguments given to `session.request`.
+
+        Returns
+        -------
+        res : requests.Response, last response (its `attempts` attribute is the count of attempts made).
+    """
+    attempt = 0
+    host = urlsplit(url).netloc
+    while True:
+        attempt += 1
+        if limiter:
+            limiter.acquire()
+        t = time.perf_counter()
+        try:
+            res = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc('http_errors_total', labels={'host':host, 'error':type(e).__name__})
+            if attempt > max_retries:
+                raise
+            delay = backoff_delay(attempt, backoff)
+            logger.warning(f'{type(e).__name__} for {method} {url} (attempt {attempt}), retry in {delay:.1f}s')
+            metrics.inc('http_retries_total', labels={'host':host})
+            time.sleep(delay)
+            continue
+        metrics.observe('http_request_seconds', time.perf_counter() - t, {'host':host})
+        metrics.inc('http_responses_total', labels={'host':host, 'status':res.status_code})
+
+        if res.status_code not in retry_status_codes or attempt > max_retries:
+            res.attempts = attempt
+            return res
+
+        delay = retry_after(res)
+        delay = backoff_delay(attempt, backoff) if delay is None else delay
+        logger.warning(f'{res.status_code} for {method} {url} (attempt {attempt}), retry in {delay:.1f}s')
+        metrics.inc('http_retries_total', labels={'host':host})
+        res.close()
+        time.sleep(delay)
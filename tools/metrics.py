@@ -0,0 +1,232 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('metrics')
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+
+
+class Histogram:
+    """
+        Cumulative histogram over fixed buckets (upper bounds), with sum and count.
+
+        Parameters
+        ----------
+        buckets : tuple of float, default=LATENCY_BUCKETS, sorted upper bounds, +Inf is implicit.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+            Estimate a quantile by linear interpolation inside its bucket (last finite bound for +Inf bucket).
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i-1] if i else 0.
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+        Thread safe registry of counters, gauges and histograms, identified by name and labels.
+        Updates only take a lock and a dict lookup, so instrumentation can stay on in production.
+        Gauges can also be callbacks, read when metrics are rendered (e.g. queue depths).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.callbacks = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def register_gauge(self, name, callback, labels=None):
+        with self.lock:
+            self.callbacks[self.key(name, labels)] = callback
+
+    def unregister_gauge(self, name, labels=None):
+        with self.lock:
+            self.callbacks.pop(self.key(name, labels), None)
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, labels)
+
+    def read_gauges(self):
+        with self.lock:
+            gauges, callbacks = dict(self.gauges), dict(self.callbacks)
+        for key, callback in callbacks.items():
+            try:
+                gauges[key] = callback()
+            except Exception:
+                logger.exception(f'failure for gauge callback {key[0]}')
+        return gauges
+
+    def snapshot(self):
+        """
+            Current values of every metric, as a json serializable dict.
+            Histograms are summarized by count, sum, p50 and p99.
+
+            Returns
+            -------
+            snapshot : dict, metric name -> list of {labels, value(s)}.
+        """
+        gauges = self.read_gauges()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key:(histogram.count, histogram.sum, histogram.quantile(.5), histogram.quantile(.99)) for key, histogram in self.histograms.items()}
+        snapshot = {}
+        for (name, labels), value in sorted(counters.items()) + sorted(gauges.items()):
+            snapshot.setdefault(name, []).append({'labels':dict(labels), 'value':value})
+        for (name, labels), (count, sum, p50, p99) in sorted(histograms.items()):
+            snapshot.setdefault(name, []).append({'labels':dict(labels), 'count':count, 'sum':round(sum, 6), 'p50':p50, 'p99':p99})
+        return snapshot
+
+    def render(self):
+        """
+            Render every metric in Prometheus text exposition format.
+
+            Returns
+            -------
+            text : str, metrics text.
+        """
+        def labels_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}' if labels else ''
+
+        gauges = self.read_gauges()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key:(histogram.buckets, list(histogram.counts), histogram.sum, histogram.count) for key, histogram in self.histograms.items()}
+        lines, typed = [], set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{labels_text(labels)} {value}')
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f'{name}{labels_text(labels)} {value}')
+        for (name, labels), (buckets, counts, sum, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{labels_text(labels)} {sum}')
+            lines.append(f'{name}_count{labels_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+metrics = Metrics() # process wide registry
+
+
+def serve_metrics(port, host='', registry=metrics):
+    """
+        Expose metrics in Prometheus text format on `http://host:port/metrics`, from a daemon thread.
+
+        Parameters
+        ----------
+        port : int, port to listen.
+        host : str, default='', interface to listen (all if empty).
+        registry : Metrics, default=metrics, registry to expose.
+
+        Returns
+        -------
+        server : ThreadingHTTPServer, running server (call `shutdown` to stop it).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # no access log
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+    logger.info(f'metrics exposed on http://{host or "0.0.0.0"}:{server.server_address[1]}/metrics')
+    return server
+
+
+def log_metrics(interval, stop, registry=metrics):
+    """
+        Log a json snapshot of metrics every `interval` seconds until `stop` is set, and once more on stop.
+        Meant to run in its own thread.
+
+        Parameters
+        ----------
+        interval : float, seconds between two logs.
+        stop : threading.Event, stop signal.
+        registry : Metrics, default=metrics, registry to log.
+    """
+    while not stop.wait(interval):
+        logger.info(json.dumps(registry.snapshot()))
+    logger.info(json.dumps(registry.snapshot()))
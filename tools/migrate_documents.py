@@ -0,0 +1,161 @@
+from client import *
+
+from time import perf_counter
+from tqdm import tqdm
+
+
+MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'pwj-db')
+MONGO_DOCUMENTS_COLLECTION = os.getenv('MONGO_DOCUMENTS_COLLECTION', 'documents')
+
+
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', 100))
+
+
+config.fileConfig('logging.conf')
+logger = logging.getLogger('migrateDocuments')
+
+
+def codec_filter(codec, fields=STORAGE_CODEC_FIELDS):
+    """
+        Build a filter matching documents with at least one field not stored with given codec.
+
+        Parameters
+        ----------
+        codec : str, target storage codec.
+        fields : list[str], default=STORAGE_CODEC_FIELDS, fields to check.
+
+        Returns
+        -------
+        filter : dict, mongodb filter.
+    """
+    if codec == 'none':
+        return {'$or':[{f'_storage.{field}':{'$exists':True}, f'_storage.{field}.codec':{'$ne':'none'}} for field in fields]}
+    return {'$or':[{field:{'$exists':True}, f'_storage.{field}.codec':{'$ne':codec}} for field in fields]}
+
+
+def migrate_codec(documents, codec, fields=STORAGE_CODEC_FIELDS, batch_size=MIGRATION_BATCH_SIZE):
+    """
+        Re-encode stored fields of existing documents with given codec (`none` to decompress them).
+        Fields above `STORAGE_GRIDFS_THRESHOLD` once encoded are offloaded to GridFS, replaced GridFS files are deleted.
+        Documents are read by increasing `_id`, so an interrupted migration can simply be run again.
+        Log any errors.
+
+        Parameters
+        ----------
+        documents : pymongo.collection.Collection, documents collection.
+        codec : str, target storage codec (`none`, `gzip` or `zstd`).
+        fields : list[str], default=STORAGE_CODEC_FIELDS, fields to migrate.
+        batch_size : int, default=MIGRATION_BATCH_SIZE, documents by bulk write.
+
+        Returns
+        -------
+        count : int, migrated documents count.
+    """
+    count, last_id = 0, None
+    migration_filter = codec_filter(codec, fields)
+    projection = {field:1 for field in fields + ['_storage']}
+    try:
+        progress = tqdm(total=documents.count_documents(migration_filter), desc=f'Migrate documents to {codec} :')
+        while True:
+            batch_filter = {**migration_filter, '_id':{'$gt':last_id}} if last_id else migration_filter
+            batch = list(documents.find(batch_filter, projection=projection, sort=[('_id', 1)], limit=batch_size))
+            if not batch:
+                break
+            operations, replaced_files = [], []
+            for document in batch:
+                replaced_files += gridfs_files(document)
+                encoded = offload_document(encode_document(decode_document(dict(document), documents), codec, fields), documents)
+                update = {'$set':{field:encoded[field] for field in fields if field in encoded}}
+                if '_storage' in encoded:
+                    update['$set']['_storage'] = encoded['_storage']
+                else:
+                    update['$unset'] = {'_storage':''}
+                operations.append(UpdateOne({'_id':document['_id']}, update))
+            bulk_write(operations, documents, ordered=False)
+            delete_files(documents, replaced_files)
+            count += len(batch)
+            last_id = batch[-1]['_id']
+            progress.update(len(batch))
+        progress.close()
+        logger.debug(f'success for migrate_codec with : codec = {codec}, fields = {fields}. {count} documents migrated')
+        return count
+    except Exception as e:
+        logger.exception(f'failure for migrate_codec with : codec = {codec}, fields = {fields}. {count} documents migrated')
+        sys.exit()
+
+
+def benchmark_codecs(documents, sample_size=100, fields=STORAGE_CODEC_FIELDS):
+    """
+        Measure stored size and encode/decode throughput of each available codec on a sample of documents,
+        and read throughput of documents as currently stored.
+
+        Parameters
+        ----------
+        documents : pymongo.collection.Collection, documents collection.
+        sample_size : int, default=100, count of sampled documents.
+        fields : list[str], default=STORAGE_CODEC_FIELDS, fields to encode.
+
+        Returns
+        -------
+        results : dict, codec -> size and throughput measures.
+    """
+    t = perf_counter()
+    sample = [decode_document(document, documents) for document in documents.aggregate([{'$sample':{'size':sample_size}}])]
+    read_time = perf_counter() - t
+    if not sample:
+        logger.warning(f'no documents to benchmark')
+        return {}
+    raw_size = sum(len(bson.encode(document)) for document in sample)
+    logger.info(f'read and decode {len(sample)} sampled documents in {read_time:.2f}s ({len(sample)/read_time:.1f} docs/s)')
+
+    results = {}
+    for codec in STORAGE_CODECS:
+        if codec == 'zstd' and zstandard is None:
+            logger.warning(f'`zstandard` is not installed, zstd codec skipped')
+            continue
+        t = perf_counter()
+        encoded = [encode_document(document, codec, fields) for document in sample]
+        encode_time = perf_counter() - t
+        t = perf_counter()
+        for document in encoded:
+            decode_document(dict(document))
+        decode_time = perf_counter() - t
+        size = sum(len(bson.encode(document)) for document in encoded)
+        results[codec] = {
+            'size':size,
+            'ratio':size / raw_size,
+            'encode_mb_s':raw_size / 2**20 / max(encode_time, 1e-9),
+            'decode_mb_s':raw_size / 2**20 / max(decode_time, 1e-9)}
+        logger.info(f'{codec:>5} : {size/2**20:8.2f} MB ({results[codec]["ratio"]:.1%} of raw), encode {results[codec]["encode_mb_s"]:8.1f} MB/s, decode {results[codec]["decode_mb_s"]:8.1f} MB/s')
+
+    stats = documents.database.command('collStats', documents.name)
+    logger.info(f'collection {documents.name} : {stats["count"]} documents, size {stats["size"]/2**20:.1f} MB, storage size {stats["storageSize"]/2**20:.1f} MB')
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Migrate or benchmark storage codec of documents collection.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compress_parser = subparsers.add_parser('compress', help='re-encode stored fields of existing documents')
+    compress_parser.add_argument('codec', choices=STORAGE_CODECS, help='target storage codec (`none` to decompress)')
+    compress_parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE, help='documents by bulk write')
+    benchmark_parser = subparsers.add_parser('benchmark', help='measure size and throughput of each codec')
+    benchmark_parser.add_argument('--sample-size', type=int, default=100, help='count of sampled documents')
+    args = parser.parse_args()
+
+    logger.info(f'start connecting mongodb and retrieve documents ...')
+    documents = get_collection(get_db(connect_mongo(), MONGO_DB_NAME), MONGO_DOCUMENTS_COLLECTION)
+
+    if args.command == 'compress':
+        count = migrate_codec(documents, args.codec, batch_size=args.batch_size)
+        logger.info(f'{count} documents migrated to {args.codec}')
+    else:
+        benchmark_codecs(documents, args.sample_size)
+
+    documents.database.client.close()
+    logger.info(f'all process ended successfuly')
@@ -1,15 +1,145 @@
+import copy
+import heapq
 import logging
+import logging.config
+import random
+
+from time import perf_counter
 
 from tqdm import tqdm
 
-from helpers import read_jsonl
+from helpers import JSONL_SUFFIXES, iter_jsonl
 
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger('processSample')
 
+def relation_pairs(relations):
+    """
+        Creates every pair of elements of each relation (score excluded), without duplicates, in order of appearance
+
+        Parameters
+        ----------
+        relations : list of relations (dicts of elements, with a score)
+    """
+    pairs, seen = [], set()
+    for relation in relations:
+        elements = [value for key, value in relation.items() if key!='score']
+        for idx, a in enumerate(elements): #crée toutes les paires possibles
+            for b in elements[idx + 1:]:
+                try:
+                    if (a,b) in seen:
+                        continue
+                    seen.add((a,b))
+                except TypeError: #éléments non hachables
+                    if [a,b] in pairs:
+                        continue
+                pairs.append([a,b])
+    return pairs
+
+def is_sweepable(sentences):
+    """
+        Checks tokens of sentences are visited in increasing order (sentences sorted and not overlapping)
+    """
+    end = 0
+    for start, stop in sentences:
+        if start < stop:
+            if start < end:
+                return False
+            end = stop
+    return True
+
 def build_tsv(json_doc):
     """
         Creates the elements of the .tsv file
+        Entities and coreference links are assigned with a sweep line over tokens : a pointer on sorted entities,
+        and for coreferences a heap of pending spans (by start) and a heap of open spans (by cluster order),
+        O((tokens + spans) log spans). Output is identical to build_tsv_reference, which is used when tokens
+        of sentences are not in increasing order
+
+        Parameters
+        ----------
+        json_doc : json document to turn into .tsv
+    """
+    sentences = json_doc['sentences']
+    if not is_sweepable(sentences):
+        return build_tsv_reference(copy.deepcopy(json_doc))
+    words = json_doc['words']
+    named_entities = sorted(json_doc['ner'])
+    clusters = list(json_doc['coref'].items()) #ordre des chaînes de coréférences : priorité et IDs WebAnno
+    spans = [sorted(v) for _, v in clusters]
+    relations = json_doc['n_ary_relations']
+
+    len_words = -1 #compteur pour le nombre de caractères dans chaque token
+    c_entities = 1
+    i_entity = 0 #position de la prochaine entité
+
+    heads = [0] * len(clusters) #position du span courant de chaque chaîne
+    d_coref = [1] * len(clusters) #compteurs d'occurences de chaque coréférence pour les IDs dans le tsv
+    pending = [(v[0][0], c_c) for c_c, v in enumerate(spans) if v] #spans courants pas encore commencés, par début
+    heapq.heapify(pending)
+    active = [] #spans courants commencés, par ordre de chaîne
+    tableau = [json_doc['doc_id']] #sert à stocker chaque ligne du futur fichier
+    d_pos = {} #position du premier élément de chaque groupe (cluster) de coréférences
+
+    for c,e in enumerate(sentences): #pour chaque phrase
+        tableau.append('#Text={}'.format(' '.join(words[e[0]:e[1]]))) #reconstitue la phrase
+        i_start = e[0]
+
+        for i in range(*e):
+            entity='_'
+            if i_entity < len(named_entities) and named_entities[i_entity][0] <= i < named_entities[i_entity][1]:
+                start, end, entity = named_entities[i_entity][:3]
+                if (start-end)<-1: #si l'entité est un groupe de tokens
+                    entity=f'{entity}[{c_entities}]'
+                if i+1==end: #fin du/des éléments à marquer
+                    i_entity+=1
+                    c_entities+=1
+
+            while pending and pending[0][0] <= i: #spans courants qui commencent
+                _, c_c = heapq.heappop(pending)
+                heapq.heappush(active, c_c)
+            while active and spans[active[0]][heads[active[0]]][1] <= i: #spans courants terminés sans être attribués : chaîne bloquée
+                heapq.heappop(active)
+
+            coref='_\t_'
+            if active: #la première chaîne dont le span courant contient le token
+                c_c = active[0]
+                coref = f'*->{c_c+1}-{d_coref[c_c]}\t[{c+1}]'
+                if i+1==spans[c_c][heads[c_c]][1]:
+                    if d_coref[c_c]==1:
+                        d_pos[clusters[c_c][0]]=f'{c+1}-{(i+1-i_start)}'
+                    heapq.heappop(active)
+                    heads[c_c]+=1
+                    d_coref[c_c]+=1
+                    if heads[c_c] < len(spans[c_c]):
+                        heapq.heappush(pending, (spans[c_c][heads[c_c]][0], c_c))
+
+            tableau.append({'p':f'{c+1}-{(i+1-i_start)}','l1':len_words+1,'l2':len_words+len(f'{words[i]} '),'mot':words[i],'entite':entity,'corf':coref}) #ajoute token en dict dans tab
+            len_words+=len(f'{words[i]} ')
+
+    positions = {} #position -> chaînes dont c'est le premier élément, dans l'ordre de d_pos
+    for k, pos in d_pos.items():
+        positions.setdefault(pos, []).append(k)
+    targets = {} #élément -> éléments en relation, dans l'ordre des paires
+    for a, b in relation_pairs(relations):
+        try:
+            if b in d_pos:
+                targets.setdefault(a, []).append(d_pos[b])
+        except TypeError: #élément non hachable, ne peut pas être une chaîne
+            pass
+
+    for line in tableau[1:]:
+        if type(line) is not str:
+            related = [target for k in positions.get(line['p'], []) for target in targets.get(k, [])]
+            line['relation'] = '|'.join(related) if related else '_'
+
+    return(tableau)
+
+def build_tsv_reference(json_doc):
+    """
+        Creates the elements of the .tsv file
+        Previous implementation, O(tokens x clusters), kept as reference of build_tsv and used as its fallback
+        for documents whose sentences are not sorted or overlap (modifies json_doc)
 
         Parameters
         ----------
@@ -128,23 +258,72 @@ def build_tsvs(jsonls:list, chemin):
 
         Parameters
         ----------
-        jsonls : list of json files
+        jsonls : iterable of json documents, processed one at a time
         chemin : path of the folder where the files will be created
     """
     for json_doc in jsonls:
         tab = build_tsv(json_doc)
         make_tsv(tab, chemin)
 
+def make_synthetic_doc(n_tokens:int, n_clusters:int, seed:int=0):
+    """
+        Creates a synthetic json document : sentences of 20 tokens, an entity every 10 tokens,
+        clusters of 1 to 10 coreference spans and relations between clusters
+
+        Parameters
+        ----------
+        n_tokens : count of tokens
+        n_clusters : count of coreference clusters
+        seed : random seed
+    """
+    rng = random.Random(seed)
+    words = [rng.choice(['the', 'model', 'BERT', 'dataset', 'F1', 'parsing', '.']) for _ in range(n_tokens)]
+    sentences = [[start, min(start + 20, n_tokens)] for start in range(0, n_tokens, 20)]
+    ner = [[start, min(start + rng.randint(1, 3), n_tokens), rng.choice(['Method', 'Task', 'Material', 'Metric'])] for start in range(0, n_tokens, 10)]
+    coref = {}
+    for c in range(n_clusters):
+        starts = rng.sample(range(max(1, n_tokens - 3)), min(rng.randint(1, 10), max(1, n_tokens - 3)))
+        coref[f'cluster_{c}'] = [[start, start + rng.randint(1, 3)] for start in starts]
+    relations = [{'Method':rng.choice(list(coref)), 'Task':rng.choice(list(coref)), 'score':rng.random()} for _ in range(n_clusters // 4)] if coref else []
+    return {'doc_id':f'synthetic_{n_tokens}_{n_clusters}', 'sentences':sentences, 'words':words, 'ner':ner, 'coref':coref, 'n_ary_relations':relations}
+
+def benchmark_build_tsv(sizes:list=[(2000, 20), (10000, 100), (20000, 300), (50000, 600)]):
+    """
+        Measures build_tsv against build_tsv_reference on synthetic documents of growing size, checking results are identical
+
+        Parameters
+        ----------
+        sizes : list of (count of tokens, count of coreference clusters)
+    """
+    results = {}
+    for n_tokens, n_clusters in sizes:
+        json_doc = make_synthetic_doc(n_tokens, n_clusters)
+        t = perf_counter()
+        reference = build_tsv_reference(copy.deepcopy(json_doc))
+        t_reference = perf_counter() - t
+        t = perf_counter()
+        tableau = build_tsv(json_doc)
+        t_sweep = perf_counter() - t
+        if tableau != reference:
+            logger.error(f'build_tsv and build_tsv_reference differ on {n_tokens} tokens and {n_clusters} clusters')
+        results[(n_tokens, n_clusters)] = (t_reference, t_sweep)
+        logger.info(f'{n_tokens} tokens, {n_clusters} clusters : reference {t_reference:.3f}s, sweep line {t_sweep:.3f}s (x{t_reference / max(t_sweep, 1e-9):.1f})')
+    return results
+
 if __name__ == '__main__':
     
     import sys
 
+    if sys.argv[1:] == ['--benchmark']: #compare build_tsv et build_tsv_reference sur des documents synthétiques
+        benchmark_build_tsv()
+        exit(0)
+
     if len(sys.argv) != 3: #vérifie que 2 arguments ont été fournis
         logger.error('two (2) arguments (path to input file and output path) needed')
         exit (1)
 
-    if sys.argv[1][-6:]!='.jsonl': #vérifie que le chemin du fichier entrée se finit par .jsonl
-        logger.error('path provided for input does not end in .jsonl')
+    if not sys.argv[1].endswith(JSONL_SUFFIXES): #vérifie que le chemin du fichier entrée se finit par .jsonl (.gz ou .zst si compressé)
+        logger.error('path provided for input does not end in .jsonl, .jsonl.gz or .jsonl.zst')
         exit(1)
 
     try:
@@ -156,5 +335,5 @@ if __name__ == '__main__':
     #ajouter vérification que chemin de sortie est valide + existe
  
 
-    jsonls = read_jsonl(sys.argv[1])
+    jsonls = iter_jsonl(sys.argv[1]) #lit les documents un par un
     build_tsvs(jsonls,sys.argv[2])
\ No newline at end of file
@@ -1,98 +1,314 @@
-import re
 import json
 import logging
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import shutil
+
 import spacy
 from tqdm import tqdm
 
 from client import *
-from helpers import write_jsonl
+from helpers import JSONL_SUFFIXES, JsonlWriter, chunked
+from columnar import COLUMNAR_SHARD_SIZE, ColumnarWriter
+from tei_parser import compare_sections, parse_tei, split_doc
 
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger('processSample')
 
-def get_grobides(ids:list):
+SPACY_MODEL = 'en_core_web_sm'
+PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', 1)) # tokenizer processes
+PROCESS_CHUNK_SIZE = 16 # maximum documents sent at once to a worker process
+TOKENIZER_BATCH_SIZE = int(os.getenv('TOKENIZER_BATCH_SIZE', 1000)) # sentences by tokenizer.pipe batch
+TEI_PARSER = os.getenv('TEI_PARSER', 'tei') # `tei` (single pass parser) or `regex` (previous regex path)
+TOKENIZER_CACHE_DIR = Path(os.getenv('TOKENIZER_CACHE_DIR', 'cache/tokenizers')) # serialized tokenizers
+GROBIDES_CHUNK_SIZE = int(os.getenv('GROBIDES_CHUNK_SIZE', 1000)) # acl ids by $in query
+GROBIDES_BATCH_SIZE = int(os.getenv('GROBIDES_BATCH_SIZE', 20)) # documents by cursor batch (TEI are up to several MB)
+
+def get_grobides(ids:list, docs=None, chunk_size:int=GROBIDES_CHUNK_SIZE, batch_size:int=GROBIDES_BATCH_SIZE):
     """
-        Takes a list of ACL ID as parameter, returns the corresponding 'grobid' data
+        Takes a list of ACL ID as parameter, yields the corresponding (acl_id, 'grobid' data) pairs
+        Only acl_id and grobid are read, ids are queried by chunks and documents streamed from the cursor by batches
 
         Parameter
         ----------
         ids : a list of ACL ids
+        docs : documents collection, connects to the database if None
+        chunk_size : ACL ids by query
+        batch_size : documents by cursor batch
     """
     if type(ids) is list:
-        docs = get_collection(get_db(connect_mongo(), MONGO_DB_NAME), MONGO_DOCUMENTS_COLLECTION)
-        return [doc['grobid'] for doc in docs.find({'acl_id':{'$in':ids}})]
+        docs = docs if docs is not None else get_collection(get_db(connect_mongo(), MONGO_DB_NAME), MONGO_DOCUMENTS_COLLECTION)
+        for chunk in chunked(ids, chunk_size):
+            cursor = docs.find({'acl_id':{'$in':chunk}, 'grobid':{'$exists':True}}, projection={'_id':0, 'acl_id':1, 'grobid':1, '_storage':1}, batch_size=batch_size)
+            for doc in cursor:
+                yield doc['acl_id'], decode_document(doc, docs)['grobid']
+        return
 
     logger.error(f'function needs a list {type(ids)}') #if the element passed as a parameter is not a list, returns an error
     exit(1) # TODO : Maybe raise ?
 
-def process_doc(doc:str, tokenizer):
+PARSERS = {'tei':parse_tei, 'regex':split_doc}
+
+def compare_parsers(docs:list):
+    """
+        Check tei parser against regex path on each document (see tei_parser.compare_sections)
+
+        Parameters
+        ----------
+        docs : list of XML documents generated by Grobid
+    """
+    identical = equivalent = 0
+    for i, doc in enumerate(docs):
+        result = compare_sections(split_doc(doc), parse_tei(doc))
+        if result == 'identical':
+            identical += 1
+        elif result == 'equivalent':
+            equivalent += 1
+        else:
+            logger.error(f'tei parser and regex path differ on document {i}')
+    logger.info(f'tei parser : {identical} identical and {equivalent} equivalent (more sentences) documents, {len(docs) - identical - equivalent} differences')
+    return identical, equivalent
+
+def benchmark_parsers(docs:list):
+    """
+        Measure MB/sec of each TEI parser
+
+        Parameters
+        ----------
+        docs : list of XML documents generated by Grobid
+    """
+    size = sum(len(doc) for doc in docs) / 2**20
+    results = {}
+    for name, parser in PARSERS.items():
+        t = perf_counter()
+        for doc in docs:
+            parser(doc)
+        t = perf_counter() - t
+        results[name] = size / t
+        logger.info(f'{name} parser : {size:.1f} MB in {t:.2f}s ({results[name]:.1f} MB/s, {len(docs) / t:.1f} docs/s)')
+    return results
+
+def process_doc(doc:str, tokenizer, batch_size:int=TOKENIZER_BATCH_SIZE, parser:str=TEI_PARSER):
     """
         For a grobid element, returns the spans of the sections, the spans of the sentences and the words contained in the document
+        Sentences of the document are tokenized in batches with `tokenizer.pipe`
 
         Parameters
         ----------
         doc : a string corresponding to a XML document generated by Grobid
+        tokenizer : spacy tokenizer
+        batch_size : sentences by tokenizer batch
+        parser : `tei` or `regex`
     """
-    sections = re.findall('(?:ead.*?</head>)(.*?)(?:<h)',doc,re.DOTALL) #cuts the document in sections between to pairs of <head> tags
-    sections.insert(0,f'<s>{re.search("(?:<title .*?>)(.*?)(?:</title>)",doc).group(1)}</s>{re.search("(?:abstract>)(.*)(?:</abstract)",doc,re.DOTALL).group(1)}') #abstract+titre
+    sections = PARSERS[parser](doc)
+    tokenized = tokenizer.pipe((sentence for sentences in sections for sentence in sentences), batch_size=batch_size) #tokenise toutes les phrases du document par lots
     len_section = 0; len_sentence = 0 #compteurs de tokens
     len_sections = []; len_sentences = []; words = [] #tableau span sections, tableau span phrases, tableau mots
-    for section in sections: #pour chaque section
-        section=re.sub('<ref type="bibr.*?</ref>','',section) #retire les références bibliographiques
-        section=re.sub('<ref.*?</ref>','[reference]',section) #remplace les références non bibliographiques
-        sentences = re.findall('(?:<s>)(.*?)(?:</s>)',section) #récupère les phrases de la section
+    for sentences in sections: #pour chaque section
         len_section = len_sentence #enregistre le span de la 1ère phrase de la section 
-        for sentence in sentences:
-            sentence = [token.orth_ for token in tokenizer(sentence)] #tokenise la phrase, récupère le résultat avec chaque token en str
-            for word in sentence:
-                words.append(word)
+        for _ in sentences:
+            sentence = [token.orth_ for token in next(tokenized)] #récupère le résultat de la phrase avec chaque token en str
+            words.extend(sentence)
             len_sentences.append([len_sentence,len_sentence+len(sentence)]) #ajoute le span de la phrase
             len_sentence+=len(sentence) #incrémente le compteur
         len_sections.append([len_section,len_sentence]) #ajoute les spans des phrases de la section
     return({'sections':len_sections,'sentences':len_sentences,'words':words})
 
-def process_docs(docs:list):
-    nlp = spacy.load('en_core_web_sm')
-    results = []
-    for doc in tqdm(docs): #pour chaque document grobid
-        results.append(process_doc(doc, nlp.tokenizer)) #fait la tokenisation, etc
+def tokenizer_cache_path(model:str=SPACY_MODEL, cache_dir:Path=TOKENIZER_CACHE_DIR):
+    """
+        Path of the serialized tokenizer of a spacy model, versioned by model and spacy versions
+
+        Parameters
+        ----------
+        model : name of spacy model
+        cache_dir : directory of serialized tokenizers
+    """
+    meta = spacy.util.get_model_meta(spacy.util.get_package_path(model))
+    return Path(cache_dir) / f'{model}-{meta["version"]}-spacy-{spacy.__version__}'
+
+def load_tokenizer(model:str=SPACY_MODEL, cache_dir:Path=TOKENIZER_CACHE_DIR, full:bool=False):
+    """
+        Load the tokenizer of a spacy model, without its other components (tagger, parser, ner ...)
+        The tokenizer is serialized in `cache_dir` on first load, later loads (and worker processes)
+        only read it in a blank pipeline of the model language, which gives the same tokens
+
+        Parameters
+        ----------
+        model : name of spacy model
+        cache_dir : directory of serialized tokenizers, None to disable cache
+        full : load the whole pipeline (reference for comparisons)
+    """
+    if full:
+        return spacy.load(model).tokenizer
+    path = tokenizer_cache_path(model, cache_dir) if cache_dir else None
+    if path and path.is_dir():
+        meta = json.loads((path / 'meta.json').read_text(encoding='utf-8'))
+        return spacy.blank(meta['lang']).tokenizer.from_disk(path / 'tokenizer')
+    meta = spacy.util.get_model_meta(spacy.util.get_package_path(model))
+    nlp = spacy.load(model, exclude=meta.get('components', meta.get('pipeline', []))) #charge seulement le vocabulaire et le tokenizer
+    if path:
+        part_path = path.with_name(f'{path.name}.{os.getpid()}.part')
+        shutil.rmtree(part_path, ignore_errors=True)
+        part_path.mkdir(parents=True) #to_disk ne crée que le dernier dossier
+        nlp.tokenizer.to_disk(part_path / 'tokenizer')
+        (part_path / 'meta.json').write_text(json.dumps({'lang':nlp.lang, 'model':model, 'version':meta['version']}), encoding='utf-8')
+        try:
+            part_path.rename(path)
+        except OSError: #déjà créé par un autre processus
+            shutil.rmtree(part_path, ignore_errors=True)
+        logger.debug(f'tokenizer of {model} serialized in {path}')
+    return nlp.tokenizer
+
+def compare_tokenizers(docs:list, model:str=SPACY_MODEL, cache_dir:Path=TOKENIZER_CACHE_DIR):
+    """
+        Measure loading time of the full pipeline, of the tokenizer only and of the cached tokenizer,
+        and check their tokens are identical on given documents
+
+        Parameters
+        ----------
+        docs : list of XML documents generated by Grobid
+        model : name of spacy model
+        cache_dir : directory of serialized tokenizers
+    """
+    results, reference = {}, None
+    for name, args in [('full', (model, None, True)), ('tokenizer', (model, None)), ('cached', (model, cache_dir))]:
+        if name == 'cached':
+            load_tokenizer(model, cache_dir) #s'assure que le cache existe
+        t = perf_counter()
+        tokenizer = load_tokenizer(*args)
+        results[name] = perf_counter() - t
+        processed = [process_doc(doc, tokenizer) for doc in docs]
+        reference = processed if reference is None else reference
+        if processed != reference:
+            logger.error(f'tokens of {name} tokenizer differ from tokens of full pipeline')
+        logger.info(f'{name} : loaded in {results[name]:.3f}s')
+    return results
+
+_worker = {} # tokenizer, batch size and parser of pool worker processes
+
+def init_worker(model:str, batch_size:int, parser:str):
+    _worker['tokenizer'] = load_tokenizer(model) #lit le tokenizer sérialisé
+    _worker['batch_size'] = batch_size
+    _worker['parser'] = parser
+
+def process_chunk_worker(chunk:list):
+    return [{'acl_id':acl_id, **process_doc(doc, _worker['tokenizer'], _worker['batch_size'], _worker['parser'])} for acl_id, doc in chunk]
+
+def process_docs(docs, workers:int=PROCESS_WORKERS, batch_size:int=TOKENIZER_BATCH_SIZE, model:str=SPACY_MODEL, parser:str=TEI_PARSER):
+    """
+        Process grobid documents one at a time, yields results in order, with their acl_id. With several workers,
+        documents are sharded in chunks over a process pool, each process reading the serialized tokenizer,
+        and at most `4 * workers` chunks are in flight so memory stays flat
+
+        Parameters
+        ----------
+        docs : iterable of (acl_id, XML document generated by Grobid), see get_grobides
+        workers : count of processes, 1 to process documents in current process
+        batch_size : sentences by tokenizer batch
+        model : name of spacy model
+        parser : `tei` or `regex`
+    """
+    tokenizer = load_tokenizer(model) #sérialise le tokenizer avant de démarrer les processus
+    if workers <= 1:
+        for acl_id, doc in docs:
+            yield {'acl_id':acl_id, **process_doc(doc, tokenizer, batch_size, parser)} #fait la tokenisation, etc
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(model, batch_size, parser)) as pool:
+        pending = deque()
+        for chunk in chunked(docs, PROCESS_CHUNK_SIZE):
+            pending.append(pool.submit(process_chunk_worker, chunk))
+            if len(pending) >= workers * 4: #attend le plus ancien lot pour conserver l'ordre des documents
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def benchmark_workers(docs:list, workers:list, batch_size:int=TOKENIZER_BATCH_SIZE, model:str=SPACY_MODEL):
+    """
+        Measure docs/sec of process_docs for each count of workers (tokenizer loading included), checking results are identical
+
+        Parameters
+        ----------
+        docs : list of (acl_id, XML document generated by Grobid)
+        workers : list of counts of processes to measure
+        batch_size : sentences by tokenizer batch
+        model : name of spacy model
+    """
+    results, reference = {}, None
+    for count in workers:
+        t = perf_counter()
+        processed = list(process_docs(docs, count, batch_size, model))
+        t = perf_counter() - t
+        reference = processed if reference is None else reference
+        if processed != reference:
+            logger.error(f'results with {count} workers differ from results with {workers[0]} workers')
+        results[count] = len(docs) / t
+        logger.info(f'{count} workers : {len(docs)} documents in {t:.2f}s ({results[count]:.1f} docs/s, x{results[count] / results[workers[0]]:.2f})')
     return results
 
 if __name__ == '__main__':
     
-    import sys
+    import argparse
     from dotenv import load_dotenv
 
-    if len(sys.argv) != 3: #vérifie que 2 arguments ont été fournis
+    parser = argparse.ArgumentParser(description='Tokenize grobid documents of given acl ids.')
+    parser.add_argument('input', help='json file with the list of acl ids')
+    parser.add_argument('output', nargs='?', help='jsonl file of results (directory for columnar format)')
+    parser.add_argument('--format', choices=['jsonl', 'columnar'], default='jsonl', help='output format')
+    parser.add_argument('--shard-size', type=int, default=COLUMNAR_SHARD_SIZE, help='documents by shard of columnar format')
+    parser.add_argument('--workers', type=int, default=PROCESS_WORKERS, help='tokenizer processes')
+    parser.add_argument('--batch-size', type=int, default=TOKENIZER_BATCH_SIZE, help='sentences by tokenizer batch')
+    parser.add_argument('--parser', choices=list(PARSERS), default=TEI_PARSER, help='TEI parser')
+    parser.add_argument('--benchmark', type=int, nargs='+', default=None, metavar='WORKERS', help='measure docs/sec for each count of workers instead of writing results')
+    parser.add_argument('--repeat', type=int, default=1, help='repeat documents to benchmark a bigger corpus')
+    args = parser.parse_args()
+
+    if args.benchmark is None and args.output is None: #vérifie que le chemin du fichier sortie a été fourni
         logger.error('two (2) arguments (input path and output path) needed')
         exit (1)
 
-    if sys.argv[2][-6:]!='.jsonl': #vérifie que le chemin du fichier sortie se finit par .jsonl
-        logger.error('path provided for output does not end in .jsonl')
+    if args.output and args.format == 'jsonl' and not args.output.endswith(JSONL_SUFFIXES): #vérifie que le chemin du fichier sortie se finit par .jsonl (.gz ou .zst pour compresser)
+        logger.error('path provided for output does not end in .jsonl, .jsonl.gz or .jsonl.zst')
         exit(1)
 
     try:
-        open(sys.argv[1],'r') #teste si le fichier entrée existe déjà
+        open(args.input,'r') #teste si le fichier entrée existe déjà
     except IOError:
         logger.error('invalid input path')
         exit(1)
 
-    try:
-        open(sys.argv[2],'r') #teste si le fichier sortie existe déjà
-    except IOError:
+    if args.output and args.format == 'jsonl':
         try:
-            open(sys.argv[2], 'w') #teste si le fichier sortie peut être créé
+            open(args.output,'r') #teste si le fichier sortie existe déjà
         except IOError:
-            logger.error('invalid output path')
-            exit(1)
+            try:
+                open(args.output, 'w') #teste si le fichier sortie peut être créé
+            except IOError:
+                logger.error('invalid output path')
+                exit(1)
 
     load_dotenv() #charge le .env pour la connexion à la BDD
  
 
-    with open(sys.argv[1]) as f:
+    with open(args.input) as f:
         ids = json.load(f)
 
-    docs = get_grobides(ids) #récupère les documents grobid
-    logger.info(f'successfully retrieved {len(docs)}/{len(ids)} documents from the database')
-    write_jsonl(sys.argv[2], process_docs(docs)) #sauvegarde les résultats
\ No newline at end of file
+    docs = get_collection(get_db(connect_mongo(), MONGO_DB_NAME), MONGO_DOCUMENTS_COLLECTION)
+    grobides = get_grobides(ids, docs) #récupère les documents grobid au fil de l'eau
+    if args.benchmark:
+        grobides = list(grobides)
+        logger.info(f'successfully retrieved {len(grobides)}/{len(ids)} documents from the database')
+        texts = [doc for _, doc in grobides]
+        compare_parsers(texts)
+        benchmark_parsers(texts * args.repeat)
+        compare_tokenizers(texts)
+        benchmark_workers(grobides * args.repeat, args.benchmark, args.batch_size)
+    else:
+        with JsonlWriter(args.output) if args.format == 'jsonl' else ColumnarWriter(args.output, args.shard_size) as writer:
+            for result in tqdm(process_docs(grobides, args.workers, args.batch_size, parser=args.parser), total=len(ids)):
+                writer.write(result) #sauvegarde les résultats au fil de l'eau
+        logger.info(f'successfully processed {writer.count}/{len(ids)} documents from the database')
+    docs.database.client.close()
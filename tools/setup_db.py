@@ -6,30 +6,86 @@ MONGO_REGISTER_COLLECTION = os.getenv('MONGO_REGISTER_COLLECTION', 'register')
 MONGO_DOCUMENTS_COLLECTION = os.getenv('MONGO_DOCUMENTS_COLLECTION', 'documents')
 
 
+DIAGNOSTIC_QUERIES = [ # (collection, description, filter, projection)
+    (MONGO_REGISTER_COLLECTION, 'claim_batch new entries', {'close':False, 'lease.expires':{'$not':{'$gte':0}}, 'retry':{'$exists':False}}, None),
+    (MONGO_REGISTER_COLLECTION, 'claim_batch due retries', {'close':False, 'lease.expires':{'$not':{'$gte':0}}, 'retry.next_attempt':{'$lte':0}}, None),
+    (MONGO_REGISTER_COLLECTION, 'open acl_ids (covered)', {'close':False}, {'_id':0, 'acl_id':1}),
+    (MONGO_REGISTER_COLLECTION, 'register entry by acl_id', {'acl_id':'P19-1001'}, None),
+    (MONGO_REGISTER_COLLECTION, 'failed steps triage', {'steps':{'$elemMatch':{'name':'grobid_api', 'code':102}}}, None),
+    (MONGO_DOCUMENTS_COLLECTION, 'get_grobides documents', {'acl_id':{'$in':['P19-1001', 'P19-1002']}}, {'acl_id':1, 'grobid':1, '_storage':1}),
+    (MONGO_DOCUMENTS_COLLECTION, 'existing acl_ids (covered)', {'acl_id':{'$in':['P19-1001', 'P19-1002']}}, {'_id':0, 'acl_id':1})]
+
+
 config.fileConfig('logging.conf')
 logger = logging.getLogger('mongoClient')
 
 
-if __name__ == '__main__':
-    host = os.getenv('MONGO_URL', 'localhost:27017')
-    username = os.getenv('MONGO_USERNAME', '')
-    password = os.getenv('MONGO_PASSWORD', '')
+def plan_summary(plan):
+    """
+        Summarize a query plan as its chain of stages, from root to leaf.
+
+        Parameters
+        ----------
+        plan : dict, `winningPlan` of an explain output.
+
+        Returns
+        -------
+        summary : str, stages (and used index) joined by ` <- `.
+    """
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        stages.append(f'{stage}({plan["indexName"]})' if 'indexName' in plan else stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' <- '.join(stages)
 
-    url = f"mongodb://{username}:{password}@{host}"
-    print(url)
 
-    client = MongoClient(url)
-    db = client['pwj-db']
-    # print(db.list_collection_names())
-    print(db['documents'].count_documents({}))
+def explain_queries(db, queries=DIAGNOSTIC_QUERIES):
+    """
+        Log explain() plan and execution stats of pipeline queries.
+
+        Parameters
+        ----------
+        db : pymongo.database.Database, mongodb database with an active connection.
+        queries : list[tuple], default=DIAGNOSTIC_QUERIES, (collection, description, filter, projection) to explain.
+
+        Returns
+        -------
+        explains : list[dict], summary of each query plan.
+    """
+    explains = []
+    for name, description, query_filter, projection in queries:
+        explain = db[name].find(query_filter, projection=projection).explain()
+        stats = explain.get('executionStats', {})
+        summary = {
+            'collection':name,
+            'query':description,
+            'plan':plan_summary(explain['queryPlanner']['winningPlan']),
+            'returned':stats.get('nReturned'),
+            'keys_examined':stats.get('totalKeysExamined'),
+            'docs_examined':stats.get('totalDocsExamined')}
+        explains.append(summary)
+        logger.info(f'{name} :: {description} :: {summary["plan"]} :: returned {summary["returned"]}, keys examined {summary["keys_examined"]}, docs examined {summary["docs_examined"]}')
+    return explains
+
+
+if __name__ == '__main__':
 
-    # db[MONGO_DB_NAME]
-    # db = get_db(db, MONGO_DB_NAME)
+    from dotenv import load_dotenv
+    load_dotenv()
 
-    # db[MONGO_REGISTER_COLLECTION]
-    # print(get_collection(db, MONGO_REGISTER_COLLECTION).count_documents({}))
+    client = connect_mongo()
+    db = client[MONGO_DB_NAME]
 
-    # db[MONGO_DOCUMENTS_COLLECTION]
-    # print(get_collection(db, MONGO_DOCUMENTS_COLLECTION).count_documents({}))
+    if len(sys.argv) > 1 and sys.argv[1] == 'explain':
+        logger.info(f'start explaining pipeline queries ...')
+        explain_queries(db)
+    else:
+        logger.info(f'start creating collections and indexes ...')
+        created = ensure_indexes(db)
+        logger.info(f'{len(created)} indexes created')
+        for name in MONGO_INDEXES:
+            check_indexes(db[name])
 
-    # logger.info(f'all process ended')
+    client.close()
+    logger.info(f'all process ended')
@@ -0,0 +1,126 @@
+import html
+import re
+
+from io import BytesIO
+
+try:
+    from lxml import etree
+    ITERPARSE_OPTIONS = {'huge_tree':True} # multi-MB TEI with coordinates
+except ImportError: # lxml is optional, standard library parser is used otherwise
+    from xml.etree import ElementTree as etree
+    ITERPARSE_OPTIONS = {}
+
+
+def local_name(tag):
+    """
+        Tag without its namespace (`{http://www.tei-c.org/ns/1.0}s` -> `s`), None for comments and processing instructions.
+    """
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+
+def sentence_text(element):
+    """
+        Text of a `<s>` element : bibliographic refs are dropped, other refs replaced by `[reference]`,
+        other inline elements (`<hi>`, `<formula>` ...) are replaced by their text.
+
+        Parameters
+        ----------
+        element : Element, `<s>` element (or one of its descendants).
+
+        Returns
+        -------
+        text : str, sentence text.
+    """
+    parts = [element.text or '']
+    for child in element:
+        tag = local_name(child.tag)
+        if tag == 'ref':
+            parts.append('' if (child.get('type') or '').startswith('bibr') else '[reference]')
+        elif tag is not None:
+            parts.append(sentence_text(child))
+        parts.append(child.tail or '')
+    return ''.join(parts)
+
+
+def parse_tei(doc):
+    """
+        Split a grobid TEI document in sections of sentences, in one pass over the document (iterparse).
+        First section is the title and the abstract sentences, then one section by `<div>` with a `<head>`
+        (body and back), holding the `<s>` sentences that follow its head.
+
+        Parameters
+        ----------
+        doc : str or bytes, XML document generated by Grobid.
+
+        Returns
+        -------
+        sections : list of list of str, sentences of each section.
+    """
+    source = BytesIO(doc.encode('utf-8') if isinstance(doc, str) else doc)
+    title, abstract, sections = None, [], []
+    stack = []
+    for event, element in etree.iterparse(source, events=('start', 'end'), **ITERPARSE_OPTIONS):
+        tag = local_name(element.tag)
+        if event == 'start':
+            stack.append(tag)
+            continue
+
+        if tag == 's':
+            if 'abstract' in stack:
+                abstract.append(sentence_text(element))
+            elif 'text' in stack and sections:
+                sections[-1].append(sentence_text(element))
+            element.clear()
+        elif tag == 'title' and title is None and 'titleStmt' in stack:
+            title = ''.join(element.itertext())
+        elif tag == 'head' and 'text' in stack and len(stack) > 1 and stack[-2] == 'div':
+            sections.append([])
+            element.clear()
+        elif tag in ('div', 'figure', 'biblStruct'):
+            element.clear()
+        stack.pop()
+    return [[title or ''] + abstract] + sections
+
+
+def split_doc(doc:str):
+    """
+        For a grobid element, returns the sentences of each section (title and abstract first), references removed or replaced
+        Regex path, kept as reference of `parse_tei`
+
+        Parameters
+        ----------
+        doc : a string corresponding to a XML document generated by Grobid
+    """
+    sections = re.findall('(?:ead.*?</head>)(.*?)(?:<h)',doc,re.DOTALL) #cuts the document in sections between to pairs of <head> tags
+    sections.insert(0,f'<s>{re.search("(?:<title .*?>)(.*?)(?:</title>)",doc).group(1)}</s>{re.search("(?:abstract>)(.*)(?:</abstract)",doc,re.DOTALL).group(1)}') #abstract+titre
+    results = []
+    for section in sections: #pour chaque section
+        section=re.sub('<ref type="bibr.*?</ref>','',section) #retire les références bibliographiques
+        section=re.sub('<ref.*?</ref>','[reference]',section) #remplace les références non bibliographiques
+        results.append(re.findall('(?:<s>)(.*?)(?:</s>)',section)) #récupère les phrases de la section
+    return results
+
+
+def compare_sections(expected, found):
+    """
+        Compare sections of the regex path with sections of the tei parser : title and abstract must be identical,
+        and every sentence found by the regex path must be found by the tei parser, in the same order (the tei parser
+        also keeps the last section, sentences with attributes and sections cut by `<hi>` tags, that the regex path misses).
+        Sentences of the regex path are compared with their entities unescaped and inline tags removed.
+
+        Parameters
+        ----------
+        expected : list of list of str, sections of `split_doc`.
+        found : list of list of str, sections of `parse_tei`.
+
+        Returns
+        -------
+        result : str or None, `identical`, `equivalent` (more sentences) or None (differences).
+    """
+    expected = [[html.unescape(re.sub('<[^>]*>', '', sentence)) for sentence in sentences] for sentences in expected]
+    if expected == found:
+        return 'identical'
+    remaining = iter(sentence for sentences in found[1:] for sentence in sentences)
+    if expected[0] == found[0] and all(sentence in remaining for sentences in expected[1:] for sentence in sentences): # ordered subsequence
+        return 'equivalent'
+    return None
@@ -1,13 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
 from time import sleep
 from typing import Iterable
 from client import *
+import hashlib
+import json
+import queue
+import shutil
+import socket
 import tempfile
-from grobid_client.grobid_client import GrobidClient
+import threading
+import uuid
+from http_helpers import RETRY_STATUS_CODES, HostSemaphores, TokenBucket, backoff_delay, make_session, request_with_retry
+from helpers import chunked
+from file_cache import FileCache, sha256_file
+from metrics import metrics, log_metrics, serve_metrics
 
-import requests
 import os
 
 
@@ -20,236 +30,933 @@ BATCH_DEFAULT_FILTER = {'close': False}
 BATCH_DEFAULT_SIZE = 100
 
 
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 5)) # failed attempts of a step before closing entry with ERROR
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 5 * 60)) # seconds before first retry, doubled at each attempt
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 24 * 60 * 60))
+WORKER_LEASE_SECONDS = float(os.getenv('WORKER_LEASE_SECONDS', 600)) # claimed entries are reclaimable once their lease expires
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 1)) # batches waiting between two stages
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', 60)) # seconds between two register polls when drained
+GROBID_CONFIG_PATH = Path('tools/grobid_config.json')
+
+
 S2_API_URL = 'https://api.semanticscholar.org/graph/v1/paper/'
 S2_API_FIELDS = 'paperId,externalIds,url,title,abstract,venue,year,referenceCount,citationCount,influentialCitationCount,isOpenAccess,fieldsOfStudy,s2FieldsOfStudy,publicationTypes,publicationDate,journal,authors,authors.externalIds,authors.url,authors.name,authors.aliases,authors.affiliations,authors.homepage,authors.paperCount,authors.citationCount,authors.hIndex,citations,citations.corpusId,citations.externalIds,citations.url,citations.title,citations.abstract,citations.venue,citations.year,citations.referenceCount,citations.citationCount,citations.influentialCitationCount,citations.isOpenAccess,citations.fieldsOfStudy,citations.s2FieldsOfStudy,citations.publicationTypes,citations.publicationDate,citations.journal,citations.authors,references,references.externalIds,references.url,references.title,references.abstract,references.venue,references.year,references.referenceCount,references.citationCount,references.influentialCitationCount,references.isOpenAccess,references.fieldsOfStudy,references.s2FieldsOfStudy,references.authors,references.publicationTypes,references.publicationDate,references.journal'
 ACL_PDF_URL= 'https://aclanthology.org/'
 
 
+S2_API_KEY = os.getenv('S2_API_KEY', '')
+S2_RATE_LIMIT = float(os.getenv('S2_RATE_LIMIT', 1)) # requests by second, 0 to disable
+S2_RATE_BURST = int(os.getenv('S2_RATE_BURST', 1))
+S2_WORKERS = int(os.getenv('S2_WORKERS', 4))
+S2_MAX_RETRIES = int(os.getenv('S2_MAX_RETRIES', 5))
+S2_API_MODE = os.getenv('S2_API_MODE', 'single') # `single` (one GET by paper) or `batch` (POST /paper/batch)
+S2_API_BATCH_MAX_SIZE = 500 # maximum ids by POST /paper/batch
+S2_API_BATCH_SIZE = min(int(os.getenv('S2_API_BATCH_SIZE', 100)), S2_API_BATCH_MAX_SIZE)
+S2_API_PAGE_SIZE = 1000 # maximum limit of /paper/{paper_id}/citations and /paper/{paper_id}/references
+S2_API_PAGED_LISTS = {'citations':('citationCount', 'citingPaper'), 'references':('referenceCount', 'citedPaper')}
+
+
+ACL_PDF_WORKERS = int(os.getenv('ACL_PDF_WORKERS', 8))
+ACL_PDF_RATE_LIMIT = float(os.getenv('ACL_PDF_RATE_LIMIT', 0)) # requests by second, 0 to disable
+ACL_PDF_HOST_CONNECTIONS = int(os.getenv('ACL_PDF_HOST_CONNECTIONS', 4)) # concurrent downloads by host
+ACL_PDF_MAX_RETRIES = int(os.getenv('ACL_PDF_MAX_RETRIES', 3))
+ACL_PDF_TIMEOUT = float(os.getenv('ACL_PDF_TIMEOUT', 60))
+ACL_PDF_CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b'%PDF-'
+
+
+GROBID_SERVICE = 'processFulltextDocument'
+GROBID_PARAMS = { # TODO : Move configuration
+    'consolidateHeader':'1',
+    'consolidateCitations':'1',
+    'segmentSentences':'1',
+    'includeRawAffiliations':'1',
+    'includeRawCitations':'1'}
+GROBID_RETRY_STATUS_CODES = (429, 502, 503, 504) # retried at once (503 : grobid pool is full), 500 is only retried as a step
+GROBID_MAX_RETRIES = int(os.getenv('GROBID_MAX_RETRIES', 10))
+
+
+FILE_CACHE_DIR = Path(os.getenv('FILE_CACHE_DIR', 'cache/files'))
+FILE_CACHE_MAX_BYTES = int(os.getenv('FILE_CACHE_MAX_BYTES', 20 * 2**30)) # 0 to disable
+
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # prometheus text endpoint, 0 to disable
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', 60)) # seconds between two json metrics logs, 0 to disable
+
+
 config.fileConfig('logging.conf')
 logger = logging.getLogger('updateDocument')
 
 
+s2_limiter = TokenBucket(S2_RATE_LIMIT, S2_RATE_BURST) # shared by every batch to respect S2 quota
+s2_session = make_session(S2_WORKERS, {'x-api-key':S2_API_KEY} if S2_API_KEY else None)
+acl_session = make_session(ACL_PDF_WORKERS)
+acl_hosts = HostSemaphores(ACL_PDF_HOST_CONNECTIONS)
+acl_limiter = TokenBucket(ACL_PDF_RATE_LIMIT, ACL_PDF_HOST_CONNECTIONS)
+file_cache = FileCache(FILE_CACHE_DIR, FILE_CACHE_MAX_BYTES) # pdfs by content hash (acl_id refs), tei by pdf hash and grobid config hash
+
+
 class StepCode(Enum):
     SUCCESS = 1
     TRASHED = 101
     ERROR = 102
-
-
-def get_batch(register, batch_size, register_filter):
+    RETRY = 103 # retryable error, entry stays open until `retry.next_attempt`
+
+
+def lease_filter(now):
+    # entries without lease, or with an expired one
+    return {'lease.expires':{'$not':{'$gte':now}}}
+
+
+def claim_batch(register, batch_size, worker_id : str = WORKER_ID, lease_seconds : float = WORKER_LEASE_SECONDS, register_filter : dict = BATCH_DEFAULT_FILTER):
+    """
+        Claim up to `batch_size` register entries for a worker.
+        Each entry is claimed with an atomic find_one_and_update setting a lease (worker id and expiry),
+        so concurrent workers never get the same entry. Entries with an expired lease (crashed worker) are reclaimed.
+        Due retries are claimed first (oldest first), then new entries. Retries not yet due are left aside.
+        Step results kept by a previous attempt (`partial`) are restored in documents.
+        Log any errors.
+
+        Parameters
+        ----------
+        register : pymongo.collection.Collection, register collection.
+        batch_size : int, maximum entries to claim.
+        worker_id : str, default=WORKER_ID, id of claiming worker.
+        lease_seconds : float, default=WORKER_LEASE_SECONDS, lease duration (renewed by `renew_leases`).
+        register_filter : dict, default=BATCH_DEFAULT_FILTER, filter of claimable entries.
+
+        Returns
+        -------
+        batch : tuple(list, list), claimed register entries and their new documents.
+    """
     try:
-        register_entries = list(register.find(register_filter, limit=batch_size))
-        batch = register_entries, [{'acl_id':entry['acl_id']} for entry in register_entries]
-        logger.debug(f'success for get_batch with : batch_size = {batch_size}, register_filter = {register_filter}')
+        register_entries = []
+        retries = True
+        while len(register_entries) < batch_size:
+            now = datetime.now().timestamp()
+            update = {'$set':{'lease':{'worker':worker_id, 'expires':now + lease_seconds}}, '$inc':{'claims':1}}
+            entry = None
+            if retries:
+                entry = register.find_one_and_update(
+                    {**register_filter, **lease_filter(now), 'retry.next_attempt':{'$lte':now}}, update,
+                    sort=[('retry.next_attempt', pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+                retries = entry is not None
+            if entry is None:
+                entry = register.find_one_and_update(
+                    {**register_filter, **lease_filter(now), 'retry':{'$exists':False}}, update,
+                    return_document=pymongo.ReturnDocument.AFTER)
+            if entry is None:
+                break
+            if entry['claims'] > 1 and 'retry' not in entry:
+                logger.warning(f'entry {entry["acl_id"]} reclaimed ({entry["claims"]} claims)')
+            entry.pop('retry', None)
+            register_entries.append(entry)
+        batch = register_entries, [{'acl_id':entry['acl_id'], **entry.pop('partial', {})} for entry in register_entries]
+        logger.debug(f'success for claim_batch with : batch_size = {batch_size}, worker_id = {worker_id}, claimed = {len(register_entries)}')
         return batch
     except:
-        logger.exception(f'failure for get_batch with : batch_size = {batch_size}, register_filter = {register_filter}')
+        logger.exception(f'failure for claim_batch with : batch_size = {batch_size}, worker_id = {worker_id}')
         sys.exit()
 
 
-def update_register_steps(entry, name, code, msg, close=False):
+def renew_leases(register, acl_ids, worker_id : str = WORKER_ID, lease_seconds : float = WORKER_LEASE_SECONDS):
+    """
+        Extend leases held by a worker (heartbeat).
+
+        Parameters
+        ----------
+        register : pymongo.collection.Collection, register collection.
+        acl_ids : list[str], acl_ids of entries in flight.
+        worker_id : str, default=WORKER_ID, id of worker holding leases.
+        lease_seconds : float, default=WORKER_LEASE_SECONDS, new lease duration from now.
+
+        Returns
+        -------
+        count : int, renewed leases count.
+    """
+    if not acl_ids:
+        return 0
+    expires = datetime.now().timestamp() + lease_seconds
+    result = register.update_many({'acl_id':{'$in':acl_ids}, 'lease.worker':worker_id}, {'$set':{'lease.expires':expires}})
+    if result.modified_count < len(acl_ids):
+        logger.warning(f'{len(acl_ids) - result.modified_count}/{len(acl_ids)} leases of {worker_id} lost')
+    return result.modified_count
+
+
+def update_register_steps(entry, name, code, msg, close=False, **info):
     now = datetime.now()
     # TODO : If step already exist raise error
-    entry['steps'].append({'name':name, 'timestamp':now.timestamp(), 'code':code.value, 'msg':msg})
+    entry['steps'].append({'name':name, 'timestamp':now.timestamp(), 'code':code.value, 'msg':msg, **info})
     entry['close'] = close
+    metrics.inc('pipeline_steps_total', labels={'step':name, 'code':code.name})
+
+
+def fail_register_step(entry, name, msg, retryable=True, **info):
+    """
+        Record a failed step. Retryable failures schedule a retry of the entry with exponential backoff
+        (RETRY step, entry stays open) until RETRY_MAX_ATTEMPTS failures of this step, others close it (ERROR step).
+
+        Parameters
+        ----------
+        entry : dict, register entry.
+        name : str, step name.
+        msg : str, step message.
+        retryable : bool, default=True, is failure transient (429, 5xx, timeout, connection error ...).
+        **info : extra step fields.
+    """
+    attempts = entry.setdefault('attempts', {})
+    attempts[name] = attempts.get(name, 0) + 1
+    if retryable and attempts[name] < RETRY_MAX_ATTEMPTS:
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts[name] - 1))
+        update_register_steps(entry, name, StepCode.RETRY, msg, False, attempt=attempts[name], **info)
+        entry['retry'] = {'step':name, 'next_attempt':datetime.now().timestamp() + delay}
+    else:
+        update_register_steps(entry, name, StepCode.ERROR, msg, True, attempt=attempts[name], **info)
+
+
+def is_active(entry):
+    # entry still to process in this run : neither closed nor waiting a retry
+    return not entry['close'] and 'retry' not in entry
+
+
+def fetch_s2_api(acl_id, url : str, fields : str, session=None, limiter=None):
+    session = session if session else s2_session
+    limiter = limiter if limiter else s2_limiter
+    try:
+        with metrics.timer('document_step_seconds', {'step':'s2_api'}):
+            res = request_with_retry(session, 'GET', f'{url}ACL:{acl_id}', limiter, S2_MAX_RETRIES, params={'fields':fields})
+        try:
+            metrics.inc('http_bytes_total', len(res.content), {'service':'s2_api', 'direction':'received'})
+            return res.status_code, res.json(), None
+        except ValueError:
+            return res.status_code, {}, None
+        finally:
+            res.close()
+    except Exception as e:
+        return None, None, e
+
+
+def get_s2_api(batch, url : str, fields : str, session=None, limiter=None, workers : int = S2_WORKERS):
+    name = 's2_api'
+
+    entries = [(entry, document) for entry, document in zip(*batch) if is_active(entry) and 's2' not in document] # s2 kept from a previous attempt is reused
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda entry: fetch_s2_api(entry['acl_id'], url, fields, session, limiter), [entry for entry, _ in entries])
+
+        for (entry, document), (status_code, content, exception) in zip(entries, results):
+            try:
+                acl_id = entry['acl_id']
+                code = StepCode.SUCCESS
+                msg = ''
+                close = False
+                retryable = False
+
+                if exception:
+                    raise exception
+                if status_code == 200:
+                    document['s2'] = content
+                    logger.debug(f'success for get_s2_api with : acl_id = {acl_id}')
+                    msg = '200'
+                elif status_code == 404:
+                    logger.warning(f'404 for get_s2_api with : acl_id = {acl_id}')
+                    code = StepCode.TRASHED
+                    close = True
+                    msg = content['error']
+                else :
+                    logger.error(f'{status_code} for get_s2_api with : acl_id = {acl_id}')
+                    code = StepCode.ERROR
+                    close = True
+                    retryable = status_code in RETRY_STATUS_CODES
+                    msg = content['error'] if 'error' in content else 'Unknow status code triggered. Check logs.'
+            except Exception as e:
+                logger.exception(f'failure for get_s2_api with : acl_id = {acl_id}')
+                code = StepCode.ERROR
+                close = True
+                retryable = True
+                msg = 'Unknow exception triggered. Check logs.'
+            finally:
+                if code == StepCode.ERROR:
+                    fail_register_step(entry, name, msg, retryable)
+                else:
+                    update_register_steps(entry, name, code, msg, close)
+
+def get_s2_pages(paper_id, name : str, url : str, fields : str, session=None, limiter=None):
+    """
+        Get full `citations` or `references` list of a paper with paged follow-ups.
+
+        Parameters
+        ----------
+        paper_id : str, s2 paper id.
+        name : str, list to get (`citations` or `references`).
+        url : str, s2 graph api paper url.
+        fields : str, comma separated fields of listed papers (without `name.` prefix).
+
+        Returns
+        -------
+        papers : list[dict], listed papers.
+    """
+    session = session if session else s2_session
+    limiter = limiter if limiter else s2_limiter
+    key = S2_API_PAGED_LISTS[name][1]
+    papers, offset = [], 0
+    while offset is not None:
+        res = request_with_retry(session, 'GET', f'{url}{paper_id}/{name}', limiter, S2_MAX_RETRIES, params={'fields':fields, 'offset':offset, 'limit':S2_API_PAGE_SIZE})
+        try:
+            if res.status_code != 200:
+                raise RuntimeError(f'{res.status_code} for {name} page at offset {offset} of {paper_id}')
+            page = res.json()
+        finally:
+            res.close()
+        papers.extend(item[key] for item in page.get('data') or [])
+        offset = page.get('next')
+    return papers
+
+
+def complete_s2_lists(paper : dict, url : str, fields : str, session=None, limiter=None):
+    """
+        Replace `citations` and `references` lists truncated by the batch endpoint with full ones.
+        Keep truncated list and log any errors.
+
+        Parameters
+        ----------
+        paper : dict, s2 paper from batch endpoint, updated in place.
+        url : str, s2 graph api paper url.
+        fields : str, comma separated fields asked to batch endpoint.
+    """
+    for name, (count_key, _) in S2_API_PAGED_LISTS.items():
+        if name not in paper or len(paper[name] or []) >= (paper.get(count_key) or 0):
+            continue
+        sub_fields = ','.join(field[len(name)+1:] for field in fields.split(',') if field.startswith(f'{name}.'))
+        try:
+            paper[name] = get_s2_pages(paper['paperId'], name, url, sub_fields, session, limiter)
+            logger.debug(f'success for complete_s2_lists with : paper_id = {paper["paperId"]}, name = {name}, count = {len(paper[name])}')
+        except Exception as e:
+            logger.exception(f'failure for complete_s2_lists with : paper_id = {paper["paperId"]}, name = {name}. truncated list kept')
 
 
-def get_s2_api(batch, url : str, fields : str):
-    
-    for entry, document in zip(*batch):
-        
-        if entry['close']:
-            continue
+def get_s2_api_batch(batch, url : str, fields : str, session=None, limiter=None, batch_size : int = S2_API_BATCH_SIZE, workers : int = S2_WORKERS):
+    name = 's2_api'
+    session = session if session else s2_session
+    limiter = limiter if limiter else s2_limiter
 
+    entries = [(entry, document) for entry, document in zip(*batch) if is_active(entry) and 's2' not in document] # s2 kept from a previous attempt is reused
+    for chunk in chunked(entries, min(batch_size, S2_API_BATCH_MAX_SIZE)):
+        papers, status_code, error, retryable = [None] * len(chunk), None, None, True
         try:
+            res = request_with_retry(session, 'POST', f'{url}batch', limiter, S2_MAX_RETRIES, params={'fields':fields}, json={'ids':[f'ACL:{entry["acl_id"]}' for entry, _ in chunk]})
+            try:
+                status_code = res.status_code
+                metrics.inc('http_bytes_total', len(res.content), {'service':'s2_api', 'direction':'received'})
+                content = res.json()
+            finally:
+                res.close()
+            if status_code == 200:
+                if not isinstance(content, list) or len(content) != len(chunk):
+                    raise ValueError(f'batch response has not one result by acl_id')
+                papers = content
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(lambda paper: complete_s2_lists(paper, url, fields, session, limiter), [paper for paper in papers if paper]))
+                logger.debug(f'success for get_s2_api_batch with : {len(chunk)} acl_ids')
+            else:
+                logger.error(f'{status_code} for get_s2_api_batch with : {len(chunk)} acl_ids')
+                retryable = status_code in RETRY_STATUS_CODES
+                error = content['error'] if isinstance(content, dict) and 'error' in content else 'Unknow status code triggered. Check logs.'
+        except Exception as e:
+            logger.exception(f'failure for get_s2_api_batch with : {len(chunk)} acl_ids')
+            error = 'Unknow exception triggered. Check logs.'
+
+        for (entry, document), paper in zip(chunk, papers):
             acl_id = entry['acl_id']
-            name = 's2_api'
-            code = StepCode.SUCCESS
-            msg = ''
-            close = False
+            if error:
+                fail_register_step(entry, name, error, retryable)
+            elif paper is None:
+                logger.warning(f'not found for get_s2_api_batch with : acl_id = {acl_id}')
+                update_register_steps(entry, name, StepCode.TRASHED, 'Paper not found in batch response', True)
+            else:
+                document['s2'] = paper
+                update_register_steps(entry, name, StepCode.SUCCESS, str(status_code), False)
+
+
+def download_pdf(url : str, path : Path, session=None, max_retries : int = ACL_PDF_MAX_RETRIES):
+    """
+        Stream a pdf to disk, checking its magic bytes and its `Content-Length`.
+        Retryable status codes are retried by `request_with_retry`, invalid or truncated downloads are retried here with jitter,
+        both from the same budget of `max_retries` retries. File is only created once complete.
+
+        Parameters
+        ----------
+        url : str, http(s) url of pdf.
+        path : Path, path of pdf to write.
+        session : requests.Session, default=None, session to use (acl_session if None).
+        max_retries : int, default=ACL_PDF_MAX_RETRIES, maximum retries (status codes and invalid downloads).
+
+        Returns
+        -------
+        status_code : int, status code of last response.
+    """
+    session = session if session else acl_session
+    part_path = path.with_suffix('.part')
+    retries = 0
+    while True:
+        with acl_hosts.hold(url):
+            res = request_with_retry(session, 'GET', url, acl_limiter, max_retries - retries, stream=True, timeout=ACL_PDF_TIMEOUT)
+            retries += res.attempts - 1 # retries already made on status codes
+            try:
+                if res.status_code != 200:
+                    return res.status_code
+                expected = res.headers.get('Content-Length') if not res.headers.get('Content-Encoding') else None
+                size, magic = 0, b''
+                with open(part_path, 'wb') as f:
+                    for chunk in res.iter_content(chunk_size=ACL_PDF_CHUNK_SIZE):
+                        magic = magic if len(magic) >= len(PDF_MAGIC) else (magic + chunk)[:len(PDF_MAGIC)]
+                        size += len(chunk)
+                        f.write(chunk)
+            finally:
+                res.close()
 
-            res = requests.get(f'{url}ACL:{acl_id}?fields={fields}')  # TODO : move url
-            if res.status_code == 200:
-                document['s2'] = res.json()
-                logger.debug(f'success for get_s2_api with : acl_id = {acl_id}')
-                msg = '200'
-            elif res.status_code == 404:
-                logger.warning(f'404 for get_s2_api with : acl_id = {acl_id}')
-                code = StepCode.TRASHED
-                close = True
-                msg = res.json()['error']
-            else :
-                logger.error(f'{res.status_code} for get_s2_api with : acl_id = {acl_id}')
+        metrics.inc('http_bytes_total', size, {'service':'acl_pdf', 'direction':'received'})
+        if magic == PDF_MAGIC and (expected is None or int(expected) == size):
+            os.replace(part_path, path)
+            return 200
+        part_path.unlink(missing_ok=True)
+        error = f'invalid pdf : magic = {magic}, size = {size}, content_length = {expected}'
+        if retries >= max_retries:
+            raise ValueError(error)
+        retries += 1
+        delay = backoff_delay(retries)
+        logger.warning(f'{error} for {url} (attempt {retries}), retry in {delay:.1f}s')
+        sleep(delay)
+
+
+def get_acl_pdf(batch : Iterable, dir_path : Path, url : str, session=None, workers : int = ACL_PDF_WORKERS, on_download=None):
+    name = 'acl_pdf'
+
+    def download(acl_id):
+        try:
+            path = dir_path / f'{acl_id}.pdf'
+            digest = file_cache.get_ref(f'{name}:{acl_id}')
+            cached = file_cache.get('pdf', digest) if digest else None
+            if cached:
+                shutil.copyfile(cached, path)
+                status_code = 200
+            else:
+                with metrics.timer('document_step_seconds', {'step':name}):
+                    status_code = download_pdf(f'{url}/{acl_id}.pdf', path, session) # TODO : move url
+                if status_code == 200 and file_cache.enabled:
+                    digest = sha256_file(path)
+                    file_cache.put('pdf', digest, src=path)
+                    file_cache.set_ref(f'{name}:{acl_id}', digest)
+            if status_code == 200 and on_download:
+                on_download(acl_id, path)
+            return status_code, None, cached is not None
+        except Exception as e:
+            return None, e, False
+
+    entries = [entry for entry, _ in zip(*batch) if is_active(entry)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(download, [entry['acl_id'] for entry in entries])
+
+        for entry, (status_code, exception, cached) in zip(entries, results):
+            try:
+                acl_id = entry['acl_id']
+                code = StepCode.SUCCESS
+                msg = ''
+                close = False
+                retryable = False
+
+                if exception:
+                    raise exception
+                if status_code == 200:
+                    logger.debug(f'success for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}, cached = {cached}')
+                elif status_code == 404:
+                    logger.warning(f'404 for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
+                    code = StepCode.TRASHED
+                    close = True
+                else :
+                    logger.error(f'{status_code} for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
+                    code = StepCode.ERROR
+                    close = True
+                    retryable = status_code in RETRY_STATUS_CODES
+                msg = f'{status_code} (cached)' if cached else str(status_code)
+            except Exception as e:
+                logger.exception(f'failure for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
                 code = StepCode.ERROR
                 close = True
-                msg = res.json()['error'] if 'error' in res.json() else 'Unknow status code triggered. Check logs.'
-        except Exception as e:
-            logger.exception(f'failure for get_s2_api with : acl_id = {acl_id}')
-            code = StepCode.ERROR
-            close = True
-            msg = 'Unknow exception triggered. Check logs.'
+                retryable = True # connection error, timeout or invalid (truncated) pdf
+                msg = 'Unknow exception triggered. Check logs.'
+            finally:
+                if code == StepCode.ERROR:
+                    fail_register_step(entry, name, msg, retryable)
+                else:
+                    update_register_steps(entry, name, code, msg, close)
+
+def load_grobid_config(config_path : Path):
+    config = json.loads(Path(config_path).read_text(encoding='utf-8'))
+    config['grobid_server'] = config['grobid_server'].rstrip('/')
+    return config
+
+
+def grobid_config_hash(config : dict):
+    # hash of every option changing grobid output, part of tei cache key
+    options = {'service':GROBID_SERVICE, 'params':GROBID_PARAMS, 'coordinates':config.get('coordinates', [])}
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+grobid_session = None # created on first post, sized by batch_size of GROBID_CONFIG_PATH
+grobid_session_lock = threading.Lock()
+
+
+def get_grobid_session():
+    global grobid_session
+    with grobid_session_lock:
+        if grobid_session is None:
+            grobid_session = make_session(load_grobid_config(GROBID_CONFIG_PATH)['batch_size'])
+    return grobid_session
+
+
+def post_grobid_document(pdf_path : Path, config : dict, session=None):
+    """
+        Post one pdf to grobid `processFulltextDocument` service.
+        Busy server (503) is retried after `sleep_time`.
+        Result is read from (and written to) file cache, keyed by pdf hash and grobid config hash.
+
+        Parameters
+        ----------
+        pdf_path : Path, path of pdf to process.
+        config : dict, grobid configuration (see `load_grobid_config`).
+        session : requests.Session, default=None, session to use (grobid_session if None).
+
+        Returns
+        -------
+        result : tuple(int, str, float, Exception, bool), status code, response text, latency in seconds, exception if any and is result cached.
+    """
+    session = session if session else get_grobid_session()
+    t = datetime.now().timestamp()
+    try:
+        params = dict(GROBID_PARAMS, teiCoordinates=config.get('coordinates', []))
+        with open(pdf_path, 'rb') as f:
+            pdf = f.read()
+        key = f'{hashlib.sha256(pdf).hexdigest()}-{grobid_config_hash(config)}'
+        cached = file_cache.get('tei', key)
+        if cached:
+            return 200, cached.read_text(encoding='utf-8'), datetime.now().timestamp() - t, None, True
+        res = request_with_retry(
+            session, 'POST', f'{config["grobid_server"]}/api/{GROBID_SERVICE}',
+            max_retries=GROBID_MAX_RETRIES, backoff=config.get('sleep_time', 5), retry_status_codes=GROBID_RETRY_STATUS_CODES,
+            files={'input':(pdf_path.name, pdf, 'application/pdf')}, data=params, timeout=config.get('timeout', 60))
+        try:
+            res.encoding = 'utf-8'
+            metrics.inc('http_bytes_total', len(pdf), {'service':'grobid_api', 'direction':'sent'})
+            metrics.inc('http_bytes_total', len(res.content), {'service':'grobid_api', 'direction':'received'})
+            metrics.observe('document_step_seconds', datetime.now().timestamp() - t, {'step':'grobid_api'})
+            if res.status_code == 200:
+                file_cache.put('tei', key, data=res.text.encode('utf-8'))
+            return res.status_code, res.text, datetime.now().timestamp() - t, None, False
         finally:
-            update_register_steps(entry, name, code, msg, close)
-            if res:
-                res.close()
-
-def get_acl_pdf(batch : Iterable, dir_path : Path, url : str):
-    name = 'acl_pdf'
+            res.close()
+    except Exception as e:
+        return None, None, datetime.now().timestamp() - t, e, False
+
+
+def post_grobid_api(batch : Iterable, config_path : Path, dir_path : Path, futures : dict = None):
+    """
+        Get grobid results of each downloaded pdf and record a step (with latency) by entry.
+        Pdfs already submitted (see `get_acl_pdf` `on_download`) are given by `futures`,
+        others are posted with a concurrency of grobid `batch_size`.
+
+        Parameters
+        ----------
+        batch : tuple(list, list), register entries and documents.
+        config_path : Path, grobid configuration path.
+        dir_path : Path, directory of downloaded pdfs.
+        futures : dict, default=None, acl_id -> Future of `post_grobid_document` result.
+    """
+    name = 'grobid_api'
+    config = load_grobid_config(config_path)
+    futures = dict(futures) if futures else {}
 
-    for entry, _ in zip(*batch):
-        
-        if entry['close']:
-            continue
+    entries = [(entry, document) for entry, document in zip(*batch) if is_active(entry)]
+    with ThreadPoolExecutor(max_workers=config['batch_size']) as pool:
+        for entry, _ in entries:
+            if entry['acl_id'] not in futures:
+                futures[entry['acl_id']] = pool.submit(post_grobid_document, dir_path / f'{entry["acl_id"]}.pdf', config)
 
-        try:
+        for entry, document in entries:
             acl_id = entry['acl_id']
             code = StepCode.SUCCESS
-            msg = ''
             close = False
-
-            res = requests.get(f'{url}/{acl_id}.pdf') # TODO : move url
-            if res.status_code == 200:
-                (dir_path / f'{acl_id}.pdf').write_bytes(res.content)
-                logger.debug(f'success for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
-            elif res.status_code == 404:
-                logger.warning(f'404 for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
-                code = StepCode.TRASHED
-                close = True
-            else :
-                logger.error(f'{res.status_code} for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
+            retryable = False
+            msg = ''
+            latency = None
+            try:
+                status_code, text, latency, exception, cached = futures[acl_id].result()
+                if exception:
+                    raise exception
+                if status_code == 200:
+                    # TODO : should we test file content is parsable (bs4, lxml ...)
+                    document['grobid'] = text
+                    msg = '200 (cached)' if cached else '200'
+                    logger.debug(f'success for post_grobid_api with : acl_id = {acl_id}, dir_path = {dir_path}, url = {config_path}, latency = {latency:.2f}s')
+                else:
+                    logger.error(f'{status_code} for post_grobid_api with : acl_id = {acl_id}, dir_path = {dir_path}, url = {config_path}')
+                    code = StepCode.ERROR
+                    close = True
+                    retryable = status_code in RETRY_STATUS_CODES
+                    msg = f'{status_code} : {text}' if text else str(status_code)
+            except Exception as e:
+                logger.exception(f'failure for post_grobid_api with : acl_id = {acl_id}, dir_path = {dir_path}, url = {config_path}')
                 code = StepCode.ERROR
                 close = True
-            msg = str(res.status_code)
-        except Exception as e:
-            logger.exception(f'failure for get_acl_pdf with : acl_id = {acl_id}, dir_path = {dir_path}, url = {url}')
-            code = StepCode.ERROR
-            close = True
-            msg = 'Unknow exception triggered. Check logs.'
-        finally:
-            update_register_steps(entry, name, code, msg, close)
-            if res:
-                res.close()
+                retryable = True # connection error or timeout
+                msg = 'Unknow exception triggered during grobid processing. Check logs.'
+            finally:
+                if code == StepCode.ERROR:
+                    fail_register_step(entry, name, msg, retryable, latency=latency)
+                else:
+                    update_register_steps(entry, name, code, msg, close, latency=latency)
 
-def post_grobid_api(batch : Iterable, config_path : Path, dir_path : Path):    
-    name = 'grobid_api'
 
-    if len(list(dir_path.glob('*.pdf'))) == 0:
-        return
+def get_s2_stage(batch, s2_mode : str = S2_API_MODE):
+    if s2_mode == 'batch':
+        get_s2_api_batch(batch, S2_API_URL, S2_API_FIELDS)
+    else:
+        get_s2_api(batch, S2_API_URL, S2_API_FIELDS)
 
-    try:
-        code = StepCode.SUCCESS
-        close = False
-        msg = ''
-
-        grobid_client = GrobidClient(config_path=config_path)
-        grobid_client.process( # TODO : Move configuration
-            "processFulltextDocument", 
-            dir_path, 
-            dir_path, 
-            consolidate_header=True,
-            consolidate_citations=True,
-            segment_sentences=True,
-            include_raw_affiliations=True,
-            include_raw_citations=True
-        )
-    except:
-        logger.exception(f'failure for post_grobid_api with : dir_path = {dir_path}, url = {config_path}')
-        code = StepCode.ERROR
-        close = True
-        msg = 'Unknow exception triggered during grobid processing. Check logs.' if msg == '' else msg
-        for entry in batch[0]:
-            update_register_steps(entry, name, code, msg, close)
-        return
-
-    for entry, document in zip(*batch):
 
-        if entry['close']:
-            continue
+def close_batch(batch, name, msg):
+    for entry in batch[0]:
+        if is_active(entry):
+            fail_register_step(entry, name, msg)
+
+
+def register_operations(batch, worker_id : str = WORKER_ID):
+    """
+        Register updates of a processed batch, applied only while `worker_id` holds the lease of each entry :
+        entries waiting a retry stay open with results of their successful steps kept in `partial`, others are closed.
+
+        Parameters
+        ----------
+        batch : tuple(list, list), register entries and documents.
+        worker_id : str, default=WORKER_ID, id of worker holding leases of the batch.
+
+        Returns
+        -------
+        operations : list[UpdateOne], one update by entry.
+    """
+    operations = []
+    for entry, doc in zip(*batch):
+        if 'retry' in entry:
+            partial = {'s2':doc['s2']} if 's2' in doc else {}
+            update = {'$set':{'steps':entry['steps'], 'attempts':entry['attempts'], 'retry':entry['retry'], 'partial':partial}, '$unset':{'lease':''}}
+        else:
+            update = {'$set':{'close':True, 'steps':entry['steps'], 'attempts':entry.get('attempts', {})}, '$unset':{'lease':'', 'retry':'', 'partial':''}}
+        operations.append(UpdateOne({'acl_id':entry['acl_id'], 'lease.worker':worker_id}, update))
+    return operations
+
+
+def write_batch(batch, register, documents, worker_id : str = WORKER_ID):
+    """
+        Upsert batch documents and close its register entries with two unordered bulk writes.
+        Entries waiting a retry stay open, with results of their successful steps kept in `partial`.
+        Entries are only updated while `worker_id` holds their lease : an entry whose lease expired and was
+        claimed by another worker is left to it, and reported as lost.
+        Both are committed in one transaction when the deployment supports it. GridFS does not support
+        transactions : oversized fields are offloaded before it, their files are deleted if it aborts,
+        and files of replaced documents once it is committed. Otherwise documents are written first :
+        upserts are idempotent, so a crash before register update only leads to open entries whose
+        document exists, closed by `reconcile_register`.
+        If the write fails, the `mongo` step of entries to write is failed (retry or error, see `fail_register_step`)
+        and the register alone is updated, outside of the failed transaction, so RETRY_MAX_ATTEMPTS also bounds
+        failing writes. The exception is raised again.
+
+        Parameters
+        ----------
+        batch : tuple(list, list), register entries and documents.
+        register : pymongo.collection.Collection, register collection.
+        documents : pymongo.collection.Collection, documents collection.
+        worker_id : str, default=WORKER_ID, id of worker holding leases of the batch.
+
+        Returns
+        -------
+        stats : dict, written documents and entries counts, lost entries, database round trips and elapsed time.
+    """
+    t = datetime.now().timestamp()
+    docs = [doc for entry, doc in zip(*batch) if is_active(entry)]
+    operations = register_operations(batch, worker_id)
 
-        try:
+    client = register.database.client
+    transaction = supports_transactions(client)
 
-            acl_id = entry['acl_id']
-            close = False
-            msg = ''
+    def write(session=None):
+        documents_result = upsert_many(docs, documents, session=session, encoded=transaction) if docs else None
+        register_result = bulk_write(operations, register, ordered=False, session=session) if operations else None
+        return documents_result, register_result
 
-            if (dir_path / f'{acl_id}.tei.xml').is_file():
-                # TODO : should we test file content is parsable (bs4, lxml ...)
-                document['grobid'] = (dir_path / f'{acl_id}.tei.xml').read_text(encoding='utf-8')
-                logger.debug(f'success for post_grobid_api with : acl_id = {acl_id}, dir_path = {dir_path}, url = {config_path}')
-            elif (dir_path / f'{acl_id}.txt').is_file():
-                msg = (dir_path / f'{acl_id}.txt').read_text(encoding='utf-8') 
-                raise
-            else:
-                msg = f'file not found : {acl_id}(.tei.xml|.txt)'
+    try:
+        if transaction:
+            docs = encode_documents(docs, documents) # GridFS files written before the transaction
+            replaced_files = find_replaced_files(docs, documents)
+            try:
+                with client.start_session() as session:
+                    documents_result, register_result = session.with_transaction(write)
+            except Exception:
+                delete_files(documents, [file_id for doc in docs for file_id in gridfs_files(doc)])
                 raise
-        except:
-            logger.exception(f'failure for post_grobid_api with : acl_id = {acl_id}, dir_path = {dir_path}, url = {config_path}')
-            code = StepCode.ERROR
-            close = True
-            msg = 'Unknow exception triggered during grobid result handling. Check logs.' if msg == '' else msg
-        finally:
-            update_register_steps(entry, name, code, msg, close)
+            delete_files(documents, [file_id for file_ids in replaced_files.values() for file_id in file_ids])
+        else:
+            documents_result, register_result = write()
+    except Exception:
+        close_batch(batch, 'mongo', 'Unknow exception triggered during mongo write. Check logs.')
+        try:
+            bulk_write(register_operations(batch, worker_id), register, ordered=False)
+        except Exception:
+            logger.exception(f'failure for write_batch while saving failed mongo step of {len(batch[0])} entries')
+        raise
+
+    stats = {
+        'documents_upserted':documents_result.upserted_count if documents_result else 0,
+        'documents_modified':documents_result.modified_count if documents_result else 0,
+        'entries_updated':register_result.modified_count if register_result else 0,
+        'entries_retried':sum('retry' in entry for entry in batch[0]),
+        'entries_lost':len(operations) - register_result.matched_count if register_result else 0,
+        'round_trips':bool(docs) + bool(operations),
+        'transaction':transaction,
+        'elapsed':datetime.now().timestamp() - t}
+    metrics.observe('mongo_write_seconds', stats['elapsed'])
+    metrics.inc('mongo_round_trips_total', stats['round_trips'])
+    metrics.inc('mongo_documents_written_total', len(docs))
+    if stats['entries_lost']:
+        metrics.inc('register_leases_lost_total', stats['entries_lost'])
+        logger.warning(f'{stats["entries_lost"]}/{len(operations)} entries of batch not updated : lease of {worker_id} lost')
+    logger.debug(f'success for write_batch ({len(docs)}/{len(batch[0])} documents) : {stats}')
+    return stats
+
+
+def reconcile_register(register, documents, chunk_size : int = BATCH_DEFAULT_SIZE * 10):
+    """
+        Close open register entries whose document already exists (batch interrupted between
+        documents and register writes), so they are not processed again.
+
+        Parameters
+        ----------
+        register : pymongo.collection.Collection, register collection.
+        documents : pymongo.collection.Collection, documents collection.
+        chunk_size : int, default=BATCH_DEFAULT_SIZE * 10, acl_ids checked by request.
+
+        Returns
+        -------
+        count : int, closed entries count.
+    """
+    count = 0
+    open_acl_ids = (entry['acl_id'] for entry in register.find(BATCH_DEFAULT_FILTER, projection={'_id':0, 'acl_id':1}))
+    for chunk in chunked(open_acl_ids, chunk_size):
+        done = [doc['acl_id'] for doc in documents.find({'acl_id':{'$in':chunk}}, projection={'_id':0, 'acl_id':1})]
+        if not done:
+            continue
+        step = {'name':'mongo', 'timestamp':datetime.now().timestamp(), 'code':StepCode.SUCCESS.value, 'msg':'document already written, entry reconciled'}
+        result = bulk_write([UpdateOne({'acl_id':acl_id, 'close':False}, {'$set':{'close':True}, '$push':{'steps':step}}) for acl_id in done], register, ordered=False)
+        count += result.modified_count
+    if count:
+        logger.warning(f'{count} open register entries already had a document, closed')
+    return count
+
 
-def process_batch(batch):
+def process_batch(batch, register, documents, s2_mode : str = S2_API_MODE):
     t = datetime.now().timestamp()
-    logger.info(f'start requesting s2 api ...')
-    get_s2_api(batch, S2_API_URL, S2_API_FIELDS)
+    logger.info(f'start requesting s2 api ({s2_mode}) ...')
+    get_s2_stage(batch, s2_mode)
 
     with tempfile.TemporaryDirectory() as tmp:
         logger.info(f'start downloading acl pdf ...')
         get_acl_pdf(batch, Path(tmp), ACL_PDF_URL)
         logger.info(f'start requesting grobid api ...')
-        post_grobid_api(batch, Path('tools/grobid_config.json'), Path(tmp))
+        post_grobid_api(batch, GROBID_CONFIG_PATH, Path(tmp))
 
     logger.info(f'start updating database ...')
+    write_batch(batch, register, documents)
 
-    docs = [doc for entry, doc in zip(*batch) if entry['close'] == False]
-    insert_many(docs, documents)
-    logger.debug(f'success for insert documents batch ({len(docs)}/{BATCH_DEFAULT_SIZE}) ...')
-    
-    for entry in batch[0]:
-        update_one({'acl_id':entry['acl_id']}, {'$set': {'close':True, 'steps':entry['steps']}}, register)
-    logger.debug(f'success updating register entries ...')
-    
     t = datetime.now().timestamp() - t
-    sleep(max(0, 5 * 60 - t))
-    register.database.client.close()
-    logger.info(f'batch process ended in {t} ({t/BATCH_DEFAULT_SIZE} by entry)')
+    logger.info(f'batch process ended in {t} ({t/max(1, len(batch[0]))} by entry)')
     return True
 
+
+def run_stage(name, func, inbox, outbox):
+    """
+        Consume batches from `inbox` until None is received, apply `func` and forward them to `outbox`.
+        Any unexpected exception closes remaining open entries of the batch with an ERROR step.
+        Stage latency, processed batches and entries, and failures are recorded in metrics.
+
+        Parameters
+        ----------
+        name : str, stage name (used as step name on unexpected exception).
+        func : callable, stage function, takes a pipeline item (dict with `batch` key).
+        inbox : queue.Queue, items to process.
+        outbox : queue.Queue or None, processed items.
+    """
+    while True:
+        item = inbox.get()
+        if item is None:
+            if outbox:
+                outbox.put(None)
+            return
+        labels = {'stage':name}
+        try:
+            with metrics.timer('pipeline_stage_seconds', labels):
+                func(item)
+            metrics.inc('pipeline_batches_total', labels=labels)
+            metrics.inc('pipeline_entries_total', len(item['batch'][0]), labels)
+        except Exception as e:
+            metrics.inc('pipeline_stage_failures_total', labels=labels)
+            logger.exception(f'failure for {name} stage with : {len(item["batch"][0])} entries')
+            close_batch(item['batch'], name, f'Unknow exception triggered during {name} stage. Check logs.')
+        if outbox:
+            outbox.put(item)
+
+
+def run_pipeline(register, documents, batch_size : int = BATCH_DEFAULT_SIZE, s2_mode : str = S2_API_MODE, queue_size : int = PIPELINE_QUEUE_SIZE, follow : bool = False, poll_interval : float = WORKER_POLL_INTERVAL, worker_id : str = WORKER_ID, lease_seconds : float = WORKER_LEASE_SECONDS, metrics_port : int = METRICS_PORT, metrics_interval : float = METRICS_LOG_INTERVAL):
+    """
+        Process open register entries with a staged pipeline : s2 -> pdf -> grobid -> mongo.
+        Each stage runs in its own thread, bounded queues between stages let batch N+1 go through
+        a stage while batch N is in the next one. Services are throttled by their own rate limits.
+        Batches are claimed with leases, renewed by a heartbeat thread while in flight, so several
+        workers (processes or nodes) can share the same register.
+        Metrics (stage and document latencies, bytes, http status codes, queue depths) are exposed
+        on `metrics_port` in Prometheus text format and logged as json every `metrics_interval` seconds.
+
+        Parameters
+        ----------
+        register : pymongo.collection.Collection, register collection.
+        documents : pymongo.collection.Collection, documents collection.
+        batch_size : int, default=BATCH_DEFAULT_SIZE, entries by batch.
+        s2_mode : str, default=S2_API_MODE, s2 api mode (`single` or `batch`).
+        queue_size : int, default=PIPELINE_QUEUE_SIZE, batches waiting between two stages.
+        follow : bool, default=False, keep polling register once drained instead of stopping.
+        poll_interval : float, default=WORKER_POLL_INTERVAL, seconds between two polls of a drained register.
+        worker_id : str, default=WORKER_ID, id of worker in leases.
+        lease_seconds : float, default=WORKER_LEASE_SECONDS, lease duration of claimed entries.
+        metrics_port : int, default=METRICS_PORT, port of metrics endpoint, 0 to disable.
+        metrics_interval : float, default=METRICS_LOG_INTERVAL, seconds between two json metrics logs, 0 to disable.
+
+        Returns
+        -------
+        count : int, processed entries count.
+    """
+    inflight, lock = set(), threading.Lock()
+    stop = threading.Event()
+    count = 0
+    reconcile_register(register, documents)
+    logger.info(f'worker {worker_id} started')
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            with lock:
+                acl_ids = list(inflight)
+            try:
+                renew_leases(register, acl_ids, worker_id, lease_seconds)
+            except Exception as e:
+                logger.exception(f'failure for renew_leases with : worker_id = {worker_id}')
+
+    def s2_stage(item):
+        get_s2_stage(item['batch'], s2_mode)
+
+    grobid_config = load_grobid_config(GROBID_CONFIG_PATH)
+    grobid_pool = ThreadPoolExecutor(max_workers=grobid_config['batch_size']) # shared by batches, bounded by grobid capacity
+
+    def pdf_stage(item):
+        item['tmp'] = tempfile.TemporaryDirectory()
+        futures = item['grobid'] = {}
+        def on_download(acl_id, path): # post each pdf to grobid as soon as it is downloaded
+            futures[acl_id] = grobid_pool.submit(post_grobid_document, path, grobid_config)
+        get_acl_pdf(item['batch'], Path(item['tmp'].name), ACL_PDF_URL, on_download=on_download)
+
+    def grobid_stage(item):
+        try:
+            if 'tmp' in item:
+                post_grobid_api(item['batch'], GROBID_CONFIG_PATH, Path(item['tmp'].name), item.pop('grobid', None))
+        finally:
+            if 'tmp' in item:
+                item.pop('tmp').cleanup()
+
+    def write_stage(item):
+        try:
+            stats = write_batch(item['batch'], register, documents, worker_id)
+            t = datetime.now().timestamp() - item['t']
+            metrics.observe('pipeline_batch_seconds', t)
+            metrics.observe('pipeline_entry_seconds', t / len(item['batch'][0]))
+            logger.info(f'batch process ended in {t} ({t/len(item["batch"][0])} by entry), written in {stats["elapsed"]:.3f}s with {stats["round_trips"]} round trips')
+        finally:
+            with lock:
+                inflight.difference_update(entry['acl_id'] for entry in item['batch'][0])
+
+    stages = [('s2_api', s2_stage), ('acl_pdf', pdf_stage), ('grobid_api', grobid_stage), ('mongo', write_stage)]
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    threads = [
+        threading.Thread(target=run_stage, args=(name, func, queues[i], queues[i+1] if i+1 < len(queues) else None), name=name)
+        for i, (name, func) in enumerate(stages)]
+    threads.append(threading.Thread(target=heartbeat, name='heartbeat'))
+    if metrics_interval > 0:
+        threads.append(threading.Thread(target=log_metrics, args=(metrics_interval, stop), name='metrics_log'))
+    for (name, _), inbox in zip(stages, queues):
+        metrics.register_gauge('pipeline_queue_depth', inbox.qsize, {'stage':name})
+    metrics.register_gauge('pipeline_inflight_entries', lambda: len(inflight))
+    server = serve_metrics(metrics_port) if metrics_port else None
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            batch = claim_batch(register, batch_size, worker_id, lease_seconds)
+            if len(batch[0]) == 0:
+                with lock:
+                    busy = len(inflight) > 0
+                if not busy and not follow:
+                    break
+                sleep(1 if busy else poll_interval) # wait in flight entries, or new (or expired) entries
+                continue
+            with lock:
+                inflight.update(entry['acl_id'] for entry in batch[0])
+            count += len(batch[0])
+            logger.info(f'start processing batch of {len(batch[0])} entries ...')
+            queues[0].put({'batch':batch, 't':datetime.now().timestamp()})
+    except KeyboardInterrupt:
+        logger.warning(f'interrupted, waiting for in flight batches ...')
+    finally:
+        queues[0].put(None)
+        for thread in threads[:len(stages)]:
+            thread.join()
+        stop.set()
+        for thread in threads[len(stages):]:
+            thread.join()
+        grobid_pool.shutdown()
+        if server:
+            server.shutdown()
+    return count
+
+
 if __name__ == '__main__':
 
+    import argparse
     from dotenv import load_dotenv
     load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Process open register entries into documents.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_DEFAULT_SIZE, help='entries by batch')
+    parser.add_argument('--s2-mode', choices=['single', 'batch'], default=S2_API_MODE, help='s2 api mode')
+    parser.add_argument('--follow', action='store_true', help='keep polling register once drained')
+    parser.add_argument('--poll-interval', type=float, default=WORKER_POLL_INTERVAL, help='seconds between two polls of a drained register')
+    parser.add_argument('--lease-seconds', type=float, default=WORKER_LEASE_SECONDS, help='lease duration of claimed entries')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='port of prometheus metrics endpoint, 0 to disable')
+    args = parser.parse_args()
     
     logger.info(f'start connecting mongodb and retrieve register and documents ...')
     db = get_db(connect_mongo(), MONGO_DB_NAME)
     register = get_collection(db, MONGO_REGISTER_COLLECTION)
     documents = get_collection(db, MONGO_DOCUMENTS_COLLECTION)
     # TODO : Check if register has same closed entries count than documents count
-    
-    logger.info(f'create register entries batch ...')
-
-    acl_ids = [
-        'W18-0615',
-        'W07-1903',
-        '2021.icnlsp-1.2',
-        'W09-0801',
-        'C69-6901',
-        '2020.parlaclarin-1.2',
-        '2020.parlaclarin-1.11',
-        '2020.parlaclarin-1.12',
-        'D19-1534',
-        'W07-0202']
-    register_entries = list(register.find({'acl_id':{'$in':acl_ids}}))
-    # print(register_entries)
-    batch = register_entries, [{'acl_id':entry['acl_id']} for entry in register_entries]
-    process_batch(batch)
-    # loop = True
-    # while loop:
-    #   batch = get_batch(register, BATCH_DEFAULT_SIZE, BATCH_DEFAULT_FILTER)
-    #   if len(batch[0]) != 0:
-    #     loop = process_batch(batch)
-
-    # logger.info(f'all process ended')
-    
 
+    logger.info(f'start processing register entries ...')
+    count = run_pipeline(register, documents, args.batch_size, args.s2_mode, follow=args.follow, poll_interval=args.poll_interval, lease_seconds=args.lease_seconds, metrics_port=args.metrics_port)
+
+    db.client.close()
+    logger.info(f'all process ended ({count} entries)')
@@ -1,11 +1,17 @@
 from client import *
+from helpers import chunked
 
+from itertools import islice
+from pathlib import Path
 from tqdm import tqdm
 import requests
 import logging
 from logging import config
 import os, re, sys
-import gzip
+import codecs
+import hashlib
+import json
+import zlib
 
 
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'pwj-db')
@@ -13,94 +19,298 @@ MONGO_REGISTER_COLLECTION = os.getenv('MONGO_REGISTER_COLLECTION', 'register')
 MONGO_DOCUMENTS_COLLECTION = os.getenv('MONGO_DOCUMENTS_COLLECTION', 'documents')
 
 
-ACL_ANTHOLOGY_URL = 'https://aclanthology.org/anthology.bib.gz'
+ACL_ANTHOLOGY_URL = os.getenv('ACL_ANTHOLOGY_URL', 'https://aclanthology.org/anthology.bib.gz')
 ACL_ID_PATTERN = re.compile(r"(?:url = \".*/)([\w\-\.]*?)(?:(?:\.pdf)?\",)")
 
 
+ANTHOLOGY_CHUNK_SIZE = int(os.getenv('ANTHOLOGY_CHUNK_SIZE', 64 * 1024))
+ANTHOLOGY_CACHE_DIR = Path(os.getenv('ANTHOLOGY_CACHE_DIR', 'cache/anthology'))
+ANTHOLOGY_CACHE_FILES = {'content':'anthology.bib.gz', 'meta':'anthology.meta.json', 'ids':'anthology.ids'}
+REGISTER_SYNC_MODE = os.getenv('REGISTER_SYNC_MODE', 'diff')
+REGISTER_CHUNK_SIZE = int(os.getenv('REGISTER_CHUNK_SIZE', 1000))
+
+
 config.fileConfig('logging.conf')
 logger = logging.getLogger('updateRegister')
 
 
-def get_url_content(url):
+def iter_gz_lines(chunks, encoding='utf-8'):
     """
-        Get content from http(s) request for given url. 
-        Raise exception if response don't have status code equal to 200.
+        Incrementally decompress gz chunks and decode them, line by line.
+        Handle multi-member gz content like `gzip.decompress`.
         Log any errors.
 
         Parameters
         ----------
-        url : str, http(s) url to request.
-        
+        chunks : iterable of bytes, gz content to decompress.
+        encoding : str, encoding to use to decode.
+
+        Returns
+        -------
+        lines : generator of str, decompressed and decoded lines (without line break).
+    """
+    try:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decoder = codecs.getincrementaldecoder(encoding)()
+        buffer = ''
+        for chunk in chunks:
+            data = b''
+            while chunk:
+                data += decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+                if decompressor.eof: # start next gz member
+                    data += decompressor.flush()
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = (buffer + decoder.decode(data)).split('\n')
+            buffer = lines.pop()
+            yield from lines
+        buffer += decoder.decode(decompressor.flush(), final=True)
+        if buffer:
+            yield buffer
+        logger.debug(f'success for content decompression ({encoding})')
+    except Exception as e:
+        logger.exception(f'failure during content decompression ({encoding})')
+        sys.exit()
+
+
+def iter_acl_ids(lines, pattern=ACL_ID_PATTERN):
+    """
+        Apply regex pattern line by line.
+        Yield only unique matchs, in order of first appearance.
+
+        Parameters
+        ----------
+        lines : iterable of str, lines to apply pattern.
+        pattern : str or re.Pattern, default=ACL_ID_PATTERN, regex pattern to use.
+
+        Returns
+        -------
+        matchs : generator of str, unique matchs.
+    """
+    pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+    seen = set()
+    for line in lines:
+        for match in pattern.findall(line):
+            if match not in seen:
+                seen.add(match)
+                yield match
+    logger.debug(f'success for iter acl_ids. {len(seen)} unique matchs with pattern : {pattern.pattern}')
+
+
+def iter_file_content(path, chunk_size=ANTHOLOGY_CHUNK_SIZE):
+    """
+        Stream content of a local file, chunk by chunk.
+
+        Parameters
+        ----------
+        path : Path, path of file to read.
+        chunk_size : int, default=ANTHOLOGY_CHUNK_SIZE, size in bytes of yielded chunks.
+
+        Returns
+        -------
+        chunks : generator of bytes, content of file.
+    """
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def ids_digest(acl_ids):
+    """
+        Compute an order independent digest of an acl_id set.
+
+        Parameters
+        ----------
+        acl_ids : iterable of str, acl_ids to digest.
+
+        Returns
+        -------
+        digest : str, sha256 hexdigest of sorted acl_ids.
+    """
+    return hashlib.sha256('\n'.join(sorted(acl_ids)).encode('utf-8')).hexdigest()
+
+
+def load_anthology_cache(cache_dir):
+    """
+        Load anthology cache metadata and last synced acl_ids.
+        Cached acl_ids are only returned if their digest matches the metadata one.
+
+        Parameters
+        ----------
+        cache_dir : Path, anthology cache directory.
+
+        Returns
+        -------
+        cache : tuple(dict, set or None), cache metadata and last synced acl_ids.
+    """
+    meta_path = cache_dir / ANTHOLOGY_CACHE_FILES['meta']
+    ids_path = cache_dir / ANTHOLOGY_CACHE_FILES['ids']
+    try:
+        meta = json.loads(meta_path.read_text(encoding='utf-8')) if meta_path.is_file() else {}
+        acl_ids = set(ids_path.read_text(encoding='utf-8').split()) if ids_path.is_file() else None
+        if acl_ids is not None and ids_digest(acl_ids) != meta.get('ids_digest'):
+            logger.warning(f'anthology cache acl_ids digest mismatch in {cache_dir}, cached acl_ids ignored')
+            acl_ids = None
+        return meta, acl_ids
+    except Exception as e:
+        logger.exception(f'failure during anthology cache loading in {cache_dir}, cache ignored')
+        return {}, None
+
+
+def save_anthology_cache(cache_dir, meta, acl_ids):
+    """
+        Persist anthology cache metadata and synced acl_ids, atomically.
+
+        Parameters
+        ----------
+        cache_dir : Path, anthology cache directory.
+        meta : dict, cache metadata (etag, last_modified, sha256, register).
+        acl_ids : set, acl_ids synced in register.
+    """
+    meta = dict(meta, ids_digest=ids_digest(acl_ids), ids_count=len(acl_ids))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for name, text in (('ids', '\n'.join(sorted(acl_ids))), ('meta', json.dumps(meta, indent=4))):
+        path = cache_dir / ANTHOLOGY_CACHE_FILES[name]
+        path.with_suffix('.part').write_text(text, encoding='utf-8')
+        os.replace(path.with_suffix('.part'), path)
+    logger.debug(f'success for anthology cache saving in {cache_dir} ({len(acl_ids)} acl_ids)')
+
+
+def get_anthology_response(url, meta, cached):
+    """
+        Send a conditional GET for anthology, using cached `ETag` and `Last-Modified`.
+        Raise exception if response status code is neither 200 nor 304.
+        Log any errors.
+
+        Parameters
+        ----------
+        url : str, http(s) url of anthology.
+        meta : dict, cache metadata.
+        cached : bool, is anthology content available in cache (conditional headers are only sent if so).
+
         Returns
         -------
-        content : bytes, content of http(s) response.
+        res : requests.Response, streamed response (200 or 304).
     """
     res = None
     try:
-        res = requests.get(url)
-        if res.status_code != 200:
+        headers = {}
+        if cached and meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        res = requests.get(url, headers=headers, stream=True)
+        if res.status_code not in (200, 304):
             raise
-        logger.debug(f'GET requests at {res.url} ended with success ({res.status_code})')
-        return res.content
+        logger.debug(f'GET requests at {res.url} started with success ({res.status_code})')
+        return res
     except Exception as e:
         code = None
         if res != None:
             code = res.status_code
             url = res.url
+            res.close()
         logger.exception(f'GET requests at {url} failed with status code {code}')
         sys.exit()
 
 
-def gz_to_text(content, encoding='utf-8'):
+def iter_response_to_file(res, path, state, chunk_size=ANTHOLOGY_CHUNK_SIZE):
     """
-        Decompress gz content and decode it. 
-        Log any errors.
+        Stream response content, chunk by chunk, while writing it to a file and hashing it.
+        File is written atomically once the response is fully consumed.
 
         Parameters
         ----------
-        content : bytes, gz content to decompress.
-        encoding : str, encoding to use to decode.
-        
+        res : requests.Response, streamed response.
+        path : Path, path of file to write.
+        state : dict, receive `sha256` hexdigest of content once fully consumed.
+        chunk_size : int, default=ANTHOLOGY_CHUNK_SIZE, size in bytes of yielded chunks.
+
         Returns
         -------
-        text : str, result from decompress and decode.
+        chunks : generator of bytes, content of response.
     """
+    sha256 = hashlib.sha256()
+    path.parent.mkdir(parents=True, exist_ok=True)
     try:
-        txt = gzip.decompress(content)
-        txt = txt.decode(encoding)
-        logger.debug(f'success for content decompression ({encoding})')
-        return txt
-    except Exception as e:
-        logger.exception(f'failure during content decompression ({encoding})')
-        sys.exit()
+        with open(path.with_suffix('.part'), 'wb') as f:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                sha256.update(chunk)
+                yield chunk
+        os.replace(path.with_suffix('.part'), path)
+        state['sha256'] = sha256.hexdigest()
+        logger.debug(f'GET requests at {res.url} ended with success ({res.status_code}), cached in {path}')
+    finally:
+        res.close()
 
 
-def find_all_in_text(pattern, text):
+def sync_anthology(register, url=ACL_ANTHOLOGY_URL, cache_dir=ANTHOLOGY_CACHE_DIR, n=None, refresh=False):
     """
-        Apply regex pattern to a text.
-        Return only unique matchs. 
-        Log any errors.
+        Update register with acl_ids from anthology, through the on-disk anthology cache.
+        - 304 (or unchanged `ETag`) with a valid cached acl_id set : nothing to parse, 0 new entries.
+        - 304 without a valid cached acl_id set : cached anthology is parsed again.
+        - 200 : anthology is streamed (and cached), only acl_ids missing from the cached set are synced.
+        Cache is only saved after a complete (not limited by `n`) sync.
 
         Parameters
         ----------
-        pattern : str or re.Pattern, regex pattern to use.
-        text : str, text to apply pattern.
-        
+        register : pymongo.collection.Collection, register collection.
+        url : str, default=ACL_ANTHOLOGY_URL, http(s) url of anthology.
+        cache_dir : Path, default=ANTHOLOGY_CACHE_DIR, anthology cache directory.
+        n : int, default=None, only process the n first acl_ids of anthology.
+        refresh : bool, default=False, ignore cache : download, parse and sync every acl_id.
+
         Returns
         -------
-        matchs : set, unique matchs.
+        counts : tuple(int, int), inserted and skipped entries count.
     """
+    content_path = cache_dir / ANTHOLOGY_CACHE_FILES['content']
+    register_name = f'{register.database.name}.{register.name}'
+    meta, cached_ids = ({}, None) if refresh else load_anthology_cache(cache_dir)
+    if meta.get('register') != register_name:
+        cached_ids = None # cached acl_ids were synced in another register
 
-    try:
-        pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
-        matchs = pattern.findall(text)
-        c = len(matchs) # store match count with duplicates
-        matchs = set(matchs)
-        logger.debug(f'success for find all in text. {c} matchs ({len(matchs)} unique) with pattern : {pattern.pattern}')
-        return matchs
-    except Exception as e:
-        logger.exception(f'failure during find all in text. pattern : {pattern.pattern}')
-        sys.exit()
+    res = get_anthology_response(url, meta, content_path.is_file() and not refresh)
+    unchanged = res.status_code == 304 or (res.headers.get('ETag') and res.headers.get('ETag') == meta.get('etag') and content_path.is_file())
+    if unchanged and cached_ids is not None:
+        res.close()
+        logger.info(f'anthology not modified since last sync ({meta.get("etag")}), 0 new entries')
+        return 0, 0
+
+    state = {}
+    if unchanged:
+        res.close()
+        logger.info(f'anthology not modified, parsing cached {content_path}')
+        chunks = iter_file_content(content_path)
+        state['sha256'] = meta.get('sha256')
+        meta['register'] = register_name
+    else:
+        previous_sha256 = meta.get('sha256')
+        meta = {'url':url, 'etag':res.headers.get('ETag'), 'last_modified':res.headers.get('Last-Modified'), 'register':register_name, 'ids_digest':meta.get('ids_digest')}
+        chunks = iter_response_to_file(res, content_path, state)
+
+    seen = set()
+    def track(acl_ids):
+        for acl_id in acl_ids:
+            seen.add(acl_id)
+            yield acl_id
+
+    acl_ids = track(iter_acl_ids(iter_gz_lines(chunks)))
+    acl_ids = islice(acl_ids, n) if n else acl_ids
+    known = cached_ids or set()
+    inserted, skipped = update_register(register, (acl_id for acl_id in acl_ids if acl_id not in known))
+    skipped += len(seen & known)
+
+    if not unchanged and state.get('sha256') == previous_sha256:
+        logger.info(f'anthology content identical to cached one ({previous_sha256})')
+    if cached_ids is not None and ids_digest(seen) == meta.get('ids_digest'):
+        logger.info(f'anthology acl_ids unchanged since last sync')
+    if not n:
+        meta['sha256'] = state.get('sha256')
+        save_anthology_cache(cache_dir, meta, seen)
+    return inserted, skipped
 
 
 def create_register_entry(acl_id, close=False, steps=None):
@@ -124,52 +334,96 @@ def create_register_entry(acl_id, close=False, steps=None):
     }
 
 
-def update_register(register, acl_ids):
+def get_register_acl_ids(register):
+    """
+        Get all acl_ids already in register, with a single projected cursor.
+
+        Parameters
+        ----------
+        register : pymongo.collection.Collection, register collection.
+
+        Returns
+        -------
+        acl_ids : set, acl_ids of register entries.
+    """
+    # sort on acl_id lets the planner use `acl_id_unique` index : covered index scan, no document fetch
+    return {entry['acl_id'] for entry in register.find({}, projection={'_id':0, 'acl_id':1}, sort=[('acl_id', 1)])}
+
+
+def update_register(register, acl_ids, mode=REGISTER_SYNC_MODE, chunk_size=REGISTER_CHUNK_SIZE):
     """
         Add in register collection a new default entry for each acl_id given.
         Only add entry if the acl_id is not already in register.
+        acl_ids are consumed chunk by chunk, so a generator can be given to overlap its production with inserts.
         Log any errors.
 
+        Two sync modes are available :
+        - `diff` load existing acl_ids once and insert the missing ones with unordered insert_many.
+        - `upsert` send unordered bulk_write of `$setOnInsert` upserts, keyed by acl_id.
+
         Parameters
         ----------
         register : pymongo.collection.Collection, register collection.
-        acl_ids : list[str], acl_ids to add in register.        
+        acl_ids : iterable of str, acl_ids to add in register.
+        mode : str, default=REGISTER_SYNC_MODE, sync mode (`diff` or `upsert`).
+        chunk_size : int, default=REGISTER_CHUNK_SIZE, count of acl_ids sent by database request.
+
+        Returns
+        -------
+        counts : tuple(int, int), inserted and skipped entries count.
     """
+    inserted, skipped = 0, 0
     try:
-        start_count = register.count_documents({})
-        for acl_id in tqdm(acl_ids, desc='Update register entries :'):
-            if not register.find_one({'acl_id':acl_id}):
-                insert_one(create_register_entry(acl_id), register)
-        end_count = register.count_documents({})
-        logger.debug(f'success for update register. added {end_count-start_count} entries, from {start_count} to {end_count}')
+        if mode not in ('diff', 'upsert'):
+            raise ValueError(f'unknown register sync mode `{mode}`')
+        existing = get_register_acl_ids(register) if mode == 'diff' else None
+        progress = tqdm(desc='Update register entries :', unit='acl_id')
+        for chunk in chunked(acl_ids, chunk_size):
+            if mode == 'diff':
+                new_acl_ids = [acl_id for acl_id in chunk if acl_id not in existing]
+                if new_acl_ids:
+                    insert_many([create_register_entry(acl_id) for acl_id in new_acl_ids], register, ordered=False)
+                    existing.update(new_acl_ids)
+                inserted += len(new_acl_ids)
+                skipped += len(chunk) - len(new_acl_ids)
+            else:
+                operations = [UpdateOne({'acl_id':acl_id}, {'$setOnInsert':create_register_entry(acl_id)}, upsert=True) for acl_id in chunk]
+                result = bulk_write(operations, register, ordered=False)
+                inserted += result.upserted_count
+                skipped += len(chunk) - result.upserted_count
+            progress.update(len(chunk))
+        progress.close()
+        logger.debug(f'success for update register ({mode}). inserted {inserted} entries, skipped {skipped} entries')
+        return inserted, skipped
     except Exception as e:
-        logger.exception(f'failure during update register. added {end_count-start_count} entries, from {start_count} to {end_count}')
+        logger.exception(f'failure during update register ({mode}). inserted {inserted} entries, skipped {skipped} entries')
         sys.exit()
 
 
 if __name__ == '__main__':
 
     N = None
-    if len(sys.argv) > 1:
-        if str.isnumeric(sys.argv[1]):
-            N = int(sys.argv[1])
+    args = [arg for arg in sys.argv[1:] if arg != '--refresh']
+    refresh = '--refresh' in sys.argv[1:]
+    if len(args) > 0:
+        if str.isnumeric(args[0]):
+            N = int(args[0])
             logger.info(f'Only {N} acl_ids will be process')
         else:
             logger.warning(f'given `n` argument is not numeric. All of acl_ids will be process')
     else:
         logger.info(f'No `n` arguments. All of acl ids will be process')
+    if refresh:
+        logger.info(f'`--refresh` given. Anthology cache will be ignored')
     
 
-    logger.info(f'start getting acl_ids from ACL anthology ...')
-    acl_ids = find_all_in_text(ACL_ID_PATTERN, gz_to_text(get_url_content(ACL_ANTHOLOGY_URL)))
-    acl_ids = list(acl_ids)[:N] if N else list(acl_ids) # Select only N acl_ids if `n` is given in args
-
     logger.info(f'start connecting mongodb and retrieve register ...')
     register = get_collection(get_db(connect_mongo(), MONGO_DB_NAME), MONGO_REGISTER_COLLECTION)
     # TODO : Check if register has same closed entries count than documents count
 
-    logger.info(f'start updating register with new acl_ids ...')
-    update_register(register, acl_ids)
+    logger.info(f'start streaming acl_ids from ACL anthology and updating register ...')
+    inserted, skipped = sync_anthology(register, ACL_ANTHOLOGY_URL, ANTHOLOGY_CACHE_DIR, N, refresh)
+    logger.info(f'register updated : {inserted} new entries, {skipped} already registered')
 
     register.database.client.close()
     logger.info(f'all process ended successfuly')